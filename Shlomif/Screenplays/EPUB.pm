@@ -14,7 +14,7 @@ use MooX qw/late/;
 use XML::LibXML               ();
 use XML::LibXML::XPathContext ();
 
-use JSON::MaybeXS qw( encode_json );
+use JSON::MaybeXS qw( decode_json encode_json );
 
 use HTML::Widgets::NavMenu::EscapeHtml qw(escape_html);
 
@@ -63,6 +63,39 @@ has 'common_json_data' => (
     },
 );
 
+# Ask a running "rebookmaker serve" server to build the EPUB, which avoids
+# paying for the Python startup on every book.
+sub _rebookmaker_server_make_epub
+{
+    my ( $socket_fn, $json_abs, $epub_fn, $base_dir, ) = @_;
+
+    require IO::Socket::UNIX;
+    my $sock = IO::Socket::UNIX->new( Peer => $socket_fn, )
+        or die "cannot connect to the rebookmaker server <<$socket_fn>> - $!";
+    $sock->print(
+        encode_json(
+            {
+                json      => $json_abs,
+                output    => $epub_fn,
+                directory => $base_dir,
+            }
+        )
+            . "\n"
+    );
+    my $line = <$sock>;
+    close($sock);
+    if ( !defined($line) )
+    {
+        die "the rebookmaker server <<$socket_fn>> closed the connection";
+    }
+    my $reply = decode_json($line);
+    if ( !$reply->{ok} )
+    {
+        die "rebookmaker server failed - $reply->{error}";
+    }
+    return;
+}
+
 eval {
     require Inline;
     Inline->import( 'Python' => <<'EOF');
@@ -72,9 +105,10 @@ import traceback
 import sys
 
 _maker = EbookMaker(compression=ZIP_DEFLATED)
-def _my_make_epub(json_filename, filename):
+def _my_make_epub(json_filename, filename, base_dir):
     try:
-        _maker.make_epub(json_filename.decode('utf-8'), filename.decode('utf-8'), )
+        _maker.make_epub(json_filename.decode('utf-8'), filename.decode('utf-8'),
+                         base_dir=base_dir.decode('utf-8'), )
     except Exception as e:
         traceback.print_tb(sys.exc_info()[2])
         raise e
@@ -86,10 +120,15 @@ EOF
 if ($@)
 {
     *_my_make_epub = sub {
-        my ( $json_abs, $epub_fn, ) = @_;
+        my ( $json_abs, $epub_fn, $base_dir, ) = @_;
+        if ( my $socket_fn = $ENV{REBOOKMAKER_SOCKET} )
+        {
+            return _rebookmaker_server_make_epub( $socket_fn, $json_abs,
+                $epub_fn, $base_dir, );
+        }
         my @cmd = (
             ( $ENV{REBOOKMAKER} || "rebookmaker" ),
-            "--output", $epub_fn, $json_abs,
+            "--output", $epub_fn, "--base-dir", $base_dir, $json_abs,
         );
         system(@cmd)
             and die "cannot run rebookmaker <<@cmd>> - $!";
@@ -261,8 +300,6 @@ sub output_json
 
     my $data_tree = $args->{data};
 
-    my $orig_dir = Path::Tiny->cwd->absolute;
-
     my $target_dir = $self->target_dir;
 
     my $epub_fn =
@@ -277,13 +314,12 @@ sub output_json
         encode_json( { %{ $self->common_json_data() }, %$data_tree }, ),
     );
 
-    {
-        chdir($target_dir);
-
-        _my_make_epub( $json_abs->stringify(), $epub_fn->stringify(), );
-
-        chdir($orig_dir);
-    }
+    # The sources are looked up in $target_dir, without a chdir().
+    _my_make_epub(
+        $json_abs->stringify(),
+        $epub_fn->stringify(),
+        $target_dir->absolute->stringify(),
+    );
 
     $epub_fn->copy( $self->out_fn );
 
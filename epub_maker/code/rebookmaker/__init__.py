@@ -22,23 +22,37 @@ incompatible with @setanta 's .
 
 """
 
-from glob import glob
+from collections import deque
+import io
 import json
+import os
 import re
+import threading
+import time
 from zipfile import ZIP_STORED
-from zipfile import ZipFile
 
-from bs4 import BeautifulSoup
-
-import jinja2
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
-from markupsafe import Markup
-# from jinja2.utils.markupsafe import Markup
-# from jinja2.utils import Markup
-# from jinja2 import Markup
-
-import importlib_resources
+# jinja2, markupsafe, importlib_resources, lxml and bs4 are imported
+# when they are first needed, to keep the startup time short.
+
+from rebookmaker.archive import ArchiveWriter
+from rebookmaker.archive import get_date_time
+from rebookmaker.archive import is_path
+from rebookmaker.cache import OutputCache
+from rebookmaker.cache import ScanCache
+from rebookmaker.compression import get_profile
+from rebookmaker.dedup import ImageDeduplicator
+from rebookmaker.dedup import rewrite_image_srcs
+from rebookmaker.minify import minify_css
+from rebookmaker.minify import minify_xhtml
+from rebookmaker.providers import DirectoryProvider
+from rebookmaker.providers import RecordingProvider
+from rebookmaker.scanner import STREAM_SCANNER
+from rebookmaker.scanner import StreamScanner
+from rebookmaker.scanner import get_scan_function
+from rebookmaker.split import split_chapter
+from rebookmaker.stats import BuildStats
+from rebookmaker.validate import ValidationError
+from rebookmaker.validate import validate_book
 
 INDENT_STEP = (' ' * 4)
 
@@ -59,38 +73,322 @@ def _get_image_type(filename, found_webp):
     raise IOError("unknown image extension for '{}'".format(filename))
 
 
-class MyCounter:
+RE = re.compile("[\\n\\r]*\\Z")
+STRIP_DOCTYPE__REGEX = re.compile(
+    "\\A((?:\\s*<\\?[^\\?]*\\?>)*)<!DOCTYPE[^>]*>",
+    re.M | re.S
+)
+
+
+def _is_glob(item):
+    """Whether the contents item is a glob of sources."""
+    return (
+        (not item.get('generate', (item['type'] == 'toc'))) and
+        item['type'] == 'text' and '*' in item['source']
+    )
 
-    """Utility class
 
+def _read_source(provider, html_src, stats=None):
+    """Read the html_src source file of provider into one buffer.
+
+    .xhtml sources are read as text so that their DOCTYPE can be
+    stripped, while the rest are kept as bytes and packaged verbatim.
     """
+    data = provider.read_bytes(html_src)
+    if stats is not None:
+        stats.bytes_read += len(data)
+    if html_src.endswith(".xhtml"):
+        # Decode it like open(html_src, 'rt') would.
+        with io.TextIOWrapper(io.BytesIO(data)) as file_handle:
+            return file_handle.read()
+    return data
 
-    def __init__(self):
-        self.counter = 0
-        self.toc_html_text = Markup('')
 
-    def get_idx(self):
-        """docstring for get_idx"""
-        self.counter += 1
-        return self.counter
+# Sources larger than that are streamed into the archive by default.
+DEFAULT_STREAM_THRESHOLD = (8 << 20)
+# The DOCTYPE of a streamed source is stripped from its first
+# PROLOG_SIZE characters.
+PROLOG_SIZE = (1 << 16)
+STREAM_CHUNK_SIZE = (1 << 16)
 
 
-RE = re.compile("[\\n\\r]*\\Z")
-STRIP_DOCTYPE__REGEX = re.compile(
-    "\\A((?:\\s*<\\?[^\\?]*\\?>)*)<!DOCTYPE[^>]*>",
-    re.M | re.S
-)
+def _iter_chunks(file_handle, chunk_size=STREAM_CHUNK_SIZE):
+    while True:
+        chunk = file_handle.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
 
 
-class EbookMaker:
-    """docstring for EbookMaker"""
-    def __init__(self, compression=ZIP_STORED):
-        self._compression = compression
-        self._templates_dirname = str(
-            importlib_resources.files(
-                __name__
-            ).joinpath('data').joinpath('templates')
+_NEWLINES = "\n\r"
+
+
+def _normalize_trailing_newlines(chunks):
+    """Yield the str chunks with their trailing newlines normalized.
+
+    The result is the same as of RE.sub("\\n", "".join(chunks)): a
+    trailing run of newlines becomes two newlines, and a text which does
+    not end with a newline gets one.
+    """
+    trailing = ''
+    for chunk in chunks:
+        stripped = chunk.rstrip(_NEWLINES)
+        if stripped:
+            yield trailing + stripped
+            trailing = chunk[len(stripped):]
+        else:
+            trailing += chunk
+    yield ("\n\n" if trailing else "\n")
+
+
+def _join_chunks(chunks, chunk_size=STREAM_CHUNK_SIZE):
+    """Join the many small str chunks of a template into larger ones."""
+    parts = []
+    length = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield ''.join(parts)
+
+
+def _iter_source_chunks(file_handle, html_src, scanner):
+    """Yield the bytes to write of the source file_handle in chunks.
+
+    Every chunk is fed to scanner (a rebookmaker.scanner.StreamScanner)
+    first.  .xhtml sources are decoded like _read_source() does and have
+    their DOCTYPE stripped from their prolog.
+    """
+    if not html_src.endswith(".xhtml"):
+        for chunk in _iter_chunks(file_handle):
+            scanner.feed(chunk)
+            yield chunk
+        return
+    with io.TextIOWrapper(file_handle) as text_handle:
+        prolog = text_handle.read(PROLOG_SIZE)
+        scanner.feed(prolog)
+        yield STRIP_DOCTYPE__REGEX.sub("\\1", prolog, 0).encode('utf-8')
+        del prolog
+        for chunk in _iter_chunks(text_handle):
+            scanner.feed(chunk)
+            yield chunk.encode('utf-8')
+
+
+def _analyse_source(html_src, payload, h_tags, scanner, scan_cache=None,
+                    max_chapter_bytes=None, minify=False):
+    """Scan payload and prepare it for packaging.
+
+    Returns the images, the heading records, the list of the (name,
+    payload) parts to write into the archive (see rebookmaker.split),
+    whether the scan results came from scan_cache, the time it took
+    to scan the payload and the (before, after) sizes in bytes of the
+    payload if it was minified (or None).
+    """
+    start = time.perf_counter()
+    cached = None
+    if scan_cache is not None:
+        key = scan_cache.get_key(payload, h_tags, scanner)
+        cached = scan_cache.get(key, html_src)
+    if cached is None:
+        page_images, page_nav = get_scan_function(scanner)(
+            text=payload, html_src=html_src, h_tags=h_tags,
         )
+        if scan_cache is not None:
+            scan_cache.put(key, html_src, page_images, page_nav)
+    else:
+        page_images, page_nav = cached
+    scan_time = time.perf_counter() - start
+    minified = None
+    if html_src.endswith(".xhtml"):
+        payload = STRIP_DOCTYPE__REGEX.sub(
+            "\\1", payload, 0
+        )
+        if minify:
+            size = len(payload.encode('utf-8'))
+            payload = minify_xhtml(payload)
+            minified = (size, len(payload.encode('utf-8')))
+    parts = [(html_src, payload)]
+    if html_src.endswith(".xhtml") and max_chapter_bytes is not None:
+        parts, get_href = split_chapter(payload, html_src, max_chapter_bytes)
+        page_nav = [
+            (level, get_href(href), label)
+            for level, href, label in page_nav
+        ]
+    return (page_images, page_nav, parts, (cached is not None), scan_time,
+            minified)
+
+
+def _analyse_source_in_worker(html_src, payload, h_tags, scanner, cache_dir,
+                              max_chapter_bytes, minify):
+    """Analyse the payload of html_src inside a worker process."""
+    return _analyse_source(
+        html_src=html_src,
+        payload=payload,
+        h_tags=h_tags,
+        scanner=scanner,
+        scan_cache=(None if cache_dir is None else ScanCache(cache_dir)),
+        max_chapter_bytes=max_chapter_bytes,
+        minify=minify,
+    )
+
+
+def _rewrite_image_srcs(payload, aliases):
+    """rewrite_image_srcs() of a str or UTF-8 bytes payload."""
+    if isinstance(payload, bytes):
+        return rewrite_image_srcs(
+            payload.decode('utf-8'), aliases).encode('utf-8')
+    return rewrite_image_srcs(payload, aliases)
+
+
+def _get_manifest(images, found_webp, htmls0):
+    """Return the manifest items which content.opf.jinja renders."""
+    manifest = list(images)
+    if found_webp:
+        manifest.append({
+            'id': 'onepixel_png', 'href': 'onepixel.png',
+            'media_type': 'image/png'})
+    manifest += [
+        {'id': 'nav', 'href': 'nav.xhtml',
+         'media_type': 'application/xhtml+xml'},
+        {'id': 'ncx', 'href': 'toc.ncx',
+         'media_type': 'application/x-dtbncx+xml'},
+    ]
+    manifest += [
+        dict(item, media_type='application/xhtml+xml') for item in htmls0]
+    manifest.append(
+        {'id': 'css', 'href': 'style.css', 'media_type': 'text/css'})
+    return manifest
+
+
+def _render_nav_points(nav_points):
+    """Render the navigation of the (level, href, label) heading records
+
+    of every source in nav_points.  Returns the <navPoint>-s of toc.ncx,
+    the <li>-s of nav.xhtml and the body of toc.xhtml.
+
+    Every label and href is escaped once and the fragments of the three
+    documents are joined at the end, so it takes linear time.
+    """
+    from markupsafe import Markup
+    from markupsafe import escape
+
+    ncx = []
+    xhtml = []
+    toc_html = []
+    counter = [0]
+
+    def _render(records, idx, level):
+        """Render records starting at idx up to the end of level."""
+        prefix = (INDENT_STEP * (level-1))
+        inner_prefix = prefix + INDENT_STEP
+        while idx < len(records):
+            rec_level, href, label = records[idx]
+            if rec_level < level:
+                return idx
+            counter[0] += 1
+            nav_idx = str(counter[0])
+            toc_html.extend([
+                '<p style="text-indent: ', str(level), 'em;">',
+                '<a href="', href, '">', label, '</a></p>\n',
+            ])
+            ncx.extend([
+                prefix, '<navPoint id="nav', nav_idx, '" playOrder="',
+                nav_idx, '">\n',
+                inner_prefix, '<navLabel><text>', label,
+                '</text></navLabel>\n',
+                inner_prefix, '<content src="', href, '"/>\n',
+            ])
+            xhtml.extend([
+                prefix, '<li>\n',
+                prefix, '<a href="', href, '">', label, '</a>\n',
+            ])
+            idx += 1
+            if idx < len(records) and records[idx][0] > level:
+                xhtml.append('<ol>')
+                idx = _render(records, idx, records[idx][0])
+                xhtml.append('</ol>')
+            ncx.extend([prefix, '</navPoint>\n'])
+            xhtml.extend([prefix, '</li>\n'])
+        return idx
+
+    for file_nav_points in nav_points:
+        toc_html.append('<div style="margin-top: 1em;">\n')
+        if len(file_nav_points):
+            # The headings of every source start at level 1.
+            delta = min([rec[0] for rec in file_nav_points]) - 1
+            _render(
+                [
+                    (level - delta, str(escape(href)), str(escape(label)))
+                    for level, href, label in file_nav_points
+                ],
+                0, 1
+            )
+        toc_html.append('</div>\n')
+    return (
+        Markup(''.join(ncx)), Markup(''.join(xhtml)), Markup(''.join(toc_html))
+    )
+
+
+TEMPLATE_CACHE_DIR_ENV_VAR = 'REBOOKMAKER_TEMPLATE_CACHE_DIR'
+
+
+def get_templates_dirname():
+    """Return the directory of the packaged templates."""
+    import importlib_resources
+
+    return str(
+        importlib_resources.files(
+            __name__
+        ).joinpath('data').joinpath('templates')
+    )
+
+
+TEMPLATE_NAMES = (
+    'cover.html', 'container.xml', 'content.opf', 'toc.ncx', 'toc.html',
+    'nav.html',
+)
+
+
+def get_template_paths():
+    """Return the paths of the templates which every build uses."""
+    dirname = get_templates_dirname()
+    return [
+        os.path.join(dirname, name + '.jinja') for name in TEMPLATE_NAMES
+    ]
+
+
+def _get_bytecode_cache():
+    """Return a persistent cache of the compiled templates or None.
+
+    It is kept in $REBOOKMAKER_TEMPLATE_CACHE_DIR (an empty value
+    disables it) or in jinja2's default per-user temporary directory.
+    """
+    import jinja2
+
+    directory = os.environ.get(TEMPLATE_CACHE_DIR_ENV_VAR)
+    if directory == '':
+        return None
+    try:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return jinja2.FileSystemBytecodeCache(directory)
+    except (OSError, RuntimeError):
+        return None
+
+
+class _Templates:
+
+    """The packaged templates, which are loaded once per process."""
+
+    def __init__(self, templates_dirname):
+        import jinja2
+        from jinja2 import Environment
+        from jinja2 import FileSystemLoader
+
         self._env = Environment(
             autoescape=jinja2.select_autoescape(
                 disabled_extensions=('nonenone',),
@@ -98,47 +396,359 @@ class EbookMaker:
                 default_for_string=True,
             ),
             loader=FileSystemLoader([
-                self._templates_dirname
+                templates_dirname
             ]),
+            bytecode_cache=_get_bytecode_cache(),
         )
-        self._cover_template = self._env.get_template('cover.html' + '.jinja')
-        self._container_xml_template = self._env.get_template(
+        self.cover_template = self._env.get_template('cover.html' + '.jinja')
+        self.container_xml_template = self._env.get_template(
             'container.xml' + '.jinja')
-        self._content_opf_template = self._env.get_template(
+        self.content_opf_template = self._env.get_template(
             'content.opf' + '.jinja')
-        self._toc_ncx_template = self._env.get_template('toc.ncx' + '.jinja')
-        self._toc_html_template = self._env.get_template('toc.html' + '.jinja')
-        self._nav_xhtml_template = self._env.get_template(
+        self.toc_ncx_template = self._env.get_template('toc.ncx' + '.jinja')
+        self.toc_html_template = self._env.get_template('toc.html' + '.jinja')
+        self.nav_xhtml_template = self._env.get_template(
             'nav.html' + '.jinja'
         )
 
-    def make_epub(self, json_fn, output_filename):
+
+_templates = None
+_templates_lock = threading.Lock()
+
+
+def _get_templates():
+    global _templates
+    with _templates_lock:
+        if _templates is None:
+            _templates = _Templates(get_templates_dirname())
+        return _templates
+
+
+class EbookMaker:
+    """docstring for EbookMaker
+
+    An EbookMaker keeps no per-book state, so one instance may build
+    several books at once from different threads, given that every
+    book has its own base_dir or provider.
+    """
+    def __init__(self, compression=ZIP_STORED, scanner=STREAM_SCANNER,
+                 workers=None, compress_threads=None, cache_dir=None,
+                 asset_cache=None, base_dir=None, stats_hook=None,
+                 output_cache_dir=None, output_cache_link=False,
+                 compression_profile=None,
+                 stream_threshold=DEFAULT_STREAM_THRESHOLD, validate=False,
+                 minify=False, dedup_images=False, auto_prune=True):
+        self._compression = compression
+        # Prune the caches after a build when they may be above their
+        # maximal sizes.  Otherwise prune_caches() should be called.
+        self._auto_prune = auto_prune
+        # Store the images with identical contents once (see
+        # rebookmaker.dedup).
+        self._dedup_images = dedup_images
+        # Strip the comments and the insignificant whitespace of the
+        # chapters and of the style sheet (see rebookmaker.minify).
+        self._minify = minify
+        # Check the structure of every book and raise a
+        # rebookmaker.validate.ValidationError instead of writing it.
+        self._validate = validate
+        # Chapters and images larger than that many bytes are streamed
+        # into the archive in chunks (None disables it).
+        self._stream_threshold = stream_threshold
+        # A rebookmaker.compression.CompressionProfile (or the name of
+        # one), which overrides compression.
+        if isinstance(compression_profile, str):
+            compression_profile = get_profile(compression_profile)
+        self._compression_profile = compression_profile
+        # An optional cache of whole EPUBs, which are copied from it (or
+        # hard linked if output_cache_link is true) on a hit.
+        self.output_cache = (
+            None if output_cache_dir is None
+            else OutputCache(output_cache_dir))
+        self._output_cache_link = output_cache_link
+        # Called with the rebookmaker.stats.BuildStats of every build.
+        self._stats_hook = stats_hook
+        # The default directory of the sources (None is the current one).
+        self._base_dir = base_dir
+        # An optional rebookmaker.archive.AssetCache shared by the books.
+        self._asset_cache = asset_cache
+        # An optional persistent cache of the chapter scan results.
+        self.scan_cache = (
+            None if cache_dir is None else ScanCache(cache_dir))
+        # The number of threads for compressing the archive members.
+        self._compress_threads = compress_threads
+        # The number of processes for analysing globbed chapters.
+        self._workers = (workers or 1)
+        # 'bs4' selects the original BeautifulSoup based scanning.
+        get_scan_function(scanner)
+        self._scanner = scanner
+        # The templates are loaded on the first build.
+
+    def prune_caches(self):
+        """Evict the least recently used entries of the caches above
+
+        their maximal sizes.
+        """
+        if self.output_cache is not None:
+            self.output_cache.prune()
+        if self.scan_cache is not None:
+            self.scan_cache.prune()
+
+    def _analyse_sources(self, provider, html_sources, h_tags, parallel,
+                         stats, max_chapter_bytes=None):
+        """Yield the analysis of each of html_sources in their order.
+
+        If parallel is true and more than one worker was requested,
+        the sources are analysed by a process pool, while keeping at
+        most a few results waiting to be consumed.  The sources are
+        always read from provider by this process.
+        """
+        scan_cache = self.scan_cache
+        if (not parallel) or self._workers < 2 or len(html_sources) < 2:
+            for html_src in html_sources:
+                yield _analyse_source(
+                    html_src=html_src,
+                    payload=_read_source(provider, html_src, stats),
+                    h_tags=h_tags,
+                    scanner=self._scanner,
+                    scan_cache=scan_cache,
+                    max_chapter_bytes=max_chapter_bytes,
+                    minify=self._minify,
+                )
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            sources = iter(html_sources)
+            pending = deque()
+
+            def _submit():
+                for html_src in sources:
+                    pending.append(executor.submit(
+                        _analyse_source_in_worker, html_src,
+                        _read_source(provider, html_src, stats), h_tags,
+                        self._scanner,
+                        (None if scan_cache is None
+                         else scan_cache.cache_dir),
+                        max_chapter_bytes, self._minify,
+                    ))
+                    return
+            for _ in range(2 * self._workers):
+                _submit()
+            while pending:
+                result = pending.popleft().result()
+                _submit()
+                yield result
+
+    def _should_stream(self, provider, name, zip_obj):
+        """Whether to stream name into zip_obj rather than read it whole."""
+        return (
+            self._stream_threshold is not None and zip_obj.can_stream and
+            provider.size(name) > self._stream_threshold
+        )
+
+    def _stream_source(self, provider, html_src, h_tags, zip_obj, arcname,
+                       stats):
+        """Scan html_src and write it as arcname, in chunks.
+
+        Returns its images and heading records.  The scan cache is not
+        used for streamed sources.
+        """
+        size = provider.size(html_src)
+        stats.bytes_read += size
+        scanner = StreamScanner(html_src=html_src, h_tags=h_tags)
+        with provider.open(html_src) as file_handle:
+            zip_obj.writestream(
+                arcname, _iter_source_chunks(file_handle, html_src, scanner),
+                self._compression, size=size)
+        return scanner.close()
+
+    def make_epub(self, json_fn, output_filename, incremental=False,
+                  provider=None, base_dir=None, only_if_changed=False):
 
         """Prepare an EPUB inside output_filename from the JSON file json_fn"""
 
         with open(json_fn, 'rb') as file_handle:
             json_data = json.load(file_handle)
-        return self.make_epub_from_data(json_data, output_filename)
+        return self._make_epub(
+            json_data, output_filename, json_fn, incremental=incremental,
+            provider=provider, base_dir=base_dir,
+            only_if_changed=only_if_changed)
 
-    def make_epub_from_data(self, json_data, output_filename):
+    def make_epub_from_data(self, json_data, output_filename,
+                            incremental=False, provider=None, base_dir=None,
+                            only_if_changed=False):
 
         """Prepare an EPUB inside output_filename from the raw JSON-like data
 
         json_data.
 
+        output_filename may also be a writable binary file object, such
+        as an io.BytesIO or a non-seekable pipe or socket.
+
+        If incremental is true and output_filename is an existing EPUB,
+        the members which did not change are copied from it without
+        being compressed again.
+
+        provider is the rebookmaker.providers.InputProvider which the
+        chapters, the images and style.css are read from.  It defaults
+        to the directory base_dir, or to the base_dir of the EbookMaker,
+        or to the current directory.  output_filename is not affected by
+        base_dir.  json_data is not modified.
+
+        If only_if_changed is true and output_filename is an existing
+        file with the same contents as the new EPUB, it is left untouched.
+
+        Returns the rebookmaker.stats.BuildStats of the build, whose
+        inputs are the paths of the files which were read.
+
         (Added at version 0.6.0 .)
         """
 
+        return self._make_epub(
+            json_data, output_filename, None, incremental=incremental,
+            provider=provider, base_dir=base_dir,
+            only_if_changed=only_if_changed)
+
+    def _get_output_settings(self):
+        """The settings which affect the output, for the output cache."""
+        return {
+            'compression': self._compression,
+            'compression_profile': (
+                None if self._compression_profile is None
+                else self._compression_profile.as_dict()),
+            'scanner': self._scanner,
+            'validate': self._validate,
+            'minify': self._minify,
+            'dedup_images': self._dedup_images,
+        }
+
+    def _expand_globs(self, json_data, provider):
+        return dict(
+            (item['source'], provider.glob(item['source']))
+            for item in json_data['contents']
+            if _is_glob(item)
+        )
+
+    def _restore_cached_output(self, output_filename, json_fn, provider,
+                               manifest_key, only_if_changed):
+        """Restore the EPUB from the output cache.
+
+        Returns the BuildStats or None on a miss.
+        """
+        manifest = self.output_cache.get_manifest(manifest_key)
+        if manifest is None:
+            return None
+        names, extra_inputs = manifest
+        stats = BuildStats()
+        try:
+            for name in names:
+                stats.bytes_read += len(provider.read_bytes(name))
+        except OSError:
+            return None
+        object_key = self.output_cache.get_object_key(
+            manifest_key, [(name, provider.digests[name]) for name in names])
+        with stats.phase('finalize'):
+            unchanged = self.output_cache.restore(
+                object_key, output_filename, link=self._output_cache_link,
+                keep_unchanged=only_if_changed)
+        if unchanged is None:
+            return None
+        stats.output_cache_hit = True
+        stats.output_unchanged = unchanged
+        stats.bytes_written = os.path.getsize(output_filename)
+        stats.inputs = (
+            ([] if json_fn is None else [json_fn]) +
+            provider.dependencies() + extra_inputs + get_template_paths()
+        )
+        return stats
+
+    def _make_epub(self, json_data, output_filename, json_fn, incremental,
+                   provider, base_dir, only_if_changed):
+        if provider is None:
+            provider = DirectoryProvider(
+                self._base_dir if base_dir is None else base_dir)
+        manifest_key = None
+        if self.output_cache is not None and is_path(output_filename):
+            manifest_key = self.output_cache.get_manifest_key(
+                json_data, self._get_output_settings(),
+                self._expand_globs(json_data, provider))
+            stats = self._restore_cached_output(
+                output_filename, json_fn,
+                RecordingProvider(provider, digest=True), manifest_key,
+                only_if_changed)
+            self.output_cache.count(stats is not None)
+            if stats is not None:
+                if self._stats_hook is not None:
+                    self._stats_hook(stats)
+                return stats
+        provider = RecordingProvider(
+            provider, digest=(manifest_key is not None))
+        modified_date = (
+            json_data['modified_date']
+            if ('modified_date' in json_data) else "2021-01-01T00:00:01Z")
+        zip_obj = ArchiveWriter(
+            output_filename,
+            date_time=get_date_time(modified_date),
+            threads=self._compress_threads,
+            reuse_previous=incremental,
+            asset_cache=self._asset_cache,
+            keep_unchanged=only_if_changed,
+            profile=self._compression_profile,
+        )
+        stats = BuildStats()
+        if self._compression_profile is not None:
+            stats.compression_profile = self._compression_profile.name
+        try:
+            self._package_book(
+                json_data, zip_obj, modified_date, provider, stats)
+        except BaseException:
+            zip_obj.abort()
+            raise
+        with stats.phase('finalize'):
+            zip_obj.close()
+        extra_inputs = stats.inputs
+        stats.inputs = (
+            ([] if json_fn is None else [json_fn]) +
+            provider.dependencies() + extra_inputs + get_template_paths()
+        )
+        if manifest_key is not None:
+            self.output_cache.put_manifest(
+                manifest_key, provider.read_names, extra_inputs)
+            self.output_cache.put(
+                self.output_cache.get_object_key(manifest_key, [
+                    (name, provider.digests[name])
+                    for name in provider.read_names
+                ]),
+                output_filename)
+            if self._auto_prune:
+                self.output_cache.maybe_prune()
+        stats.output_unchanged = zip_obj.unchanged
+        stats.stored_uncompressible = zip_obj.stored_uncompressible
+        stats.bytes_written = zip_obj.size
+        stats.add_members(zip_obj.infolist())
+        if self.scan_cache is not None and self._auto_prune:
+            self.scan_cache.maybe_prune()
+        if self._stats_hook is not None:
+            self._stats_hook(stats)
+        return stats
+
+    def _package_book(self, json_data, zip_obj, modified_date, provider,
+                      stats):
+        """Write the members of the book json_data using zip_obj."""
+        templates = _get_templates()
+
         _compression = self._compression
 
+        def _read_bytes(fn):
+            data = provider.read_bytes(fn)
+            stats.bytes_read += len(data)
+            return data
+
         def _write_mimetype_file_first(zip_obj):
             """docstring for _write_mimetype_file_first"""
             zip_obj.writestr("mimetype", "application/epub+zip", ZIP_STORED)
 
         def _path(fn):
             return 'OEBPS/' + fn
-        zip_obj = ZipFile(output_filename, 'w')
-        _write_mimetype_file_first(zip_obj)
         images = set()
         cover_image_fn = json_data['cover']
         # images.add(cover_image_fn)
@@ -147,54 +757,96 @@ class EbookMaker:
             h_tags.append("h"+str(i))
         h_tags = tuple(h_tags)
         htmls = []
-        for html_src in ['cover.xhtml']:
-            zip_obj.writestr(
-                _path(html_src),
-                (self._cover_template.render(
-                    tab="\t",
-                    cover_image_fn=cover_image_fn,
-                    esc_title=json_data['title']) + "\n"),
-                _compression)
+
+        def _write_head():
+            _write_mimetype_file_first(zip_obj)
+            for html_src in ['cover.xhtml']:
+                with stats.phase('render'):
+                    zip_obj.writestr(
+                        _path(html_src),
+                        (templates.cover_template.render(
+                            tab="\t",
+                            cover_image_fn=cover_image_fn,
+                            esc_title=json_data['title']) + "\n"),
+                        _compression)
+        # When validating, no member is written before the book passed
+        # the checks, so the (member, payload) of the chapters are kept
+        # until then.
+        deferred = ([] if self._validate else None)
+        if deferred is None:
+            _write_head()
         nav_points = []
+        dedup = None
+        if self._dedup_images:
+            dedup = ImageDeduplicator(provider)
+            # The cover is the canonical copy of its contents.
+            dedup.get_canonical(cover_image_fn)
         for item in json_data['contents']:
-            if 'generate' not in item:
-                item['generate'] = (item['type'] == 'toc')
-            if item['generate']:
+            if item.get('generate', (item['type'] == 'toc')):
                 continue
             source_spec = item['source']
-            if item['type'] == 'text' and '*' in source_spec:
-                html_sources = sorted(glob(source_spec))
+            is_glob = _is_glob(item)
+            if is_glob:
+                html_sources = provider.glob(source_spec)
             else:
                 html_sources = [source_spec]
+            # Sources larger than that are split at their headings.
+            max_chapter_bytes = item.get(
+                'max_chapter_bytes',
+                json_data['toc'].get('max_chapter_bytes'))
+            streamed = set(
+                html_src for html_src in html_sources
+                if self._should_stream(provider, html_src, zip_obj) and
+                self._scanner == STREAM_SCANNER and
+                max_chapter_bytes is None and not self._minify and
+                not self._dedup_images and deferred is None
+            )
+            # Each source is read once and the same buffer is scanned,
+            # stripped and written before the next one is read.
+            results = self._analyse_sources(
+                provider,
+                [html_src for html_src in html_sources
+                 if html_src not in streamed],
+                h_tags, parallel=is_glob, stats=stats,
+                max_chapter_bytes=max_chapter_bytes)
             for html_src in html_sources:
-                page_nav = []
-                htmls.append(html_src)
-                with open(html_src, 'rt') as file_handle:
-                    text = file_handle.read()
-                soup = BeautifulSoup(text, features='lxml-xml', )
-                for img in soup.find_all('img'):
-                    src = img['src']
-                    if src:
-                        images.add(src)
-                for h_elem in soup.find_all(h_tags):
-                    if h_elem.has_attr('id'):
-                        href = html_src+"#"+h_elem['id']
-                    else:
-                        # Skip
-                        href = None
-                        continue
-                    page_nav.append(
-                        {
-                            'level': int(h_elem.name[-1]),
-                            'href': href,
-                            'label': h_elem.get_text(),
-                        }
-                    )
+                start = time.perf_counter()
+                if html_src in streamed:
+                    page_images, page_nav = self._stream_source(
+                        provider, html_src, h_tags, zip_obj,
+                        _path(html_src), stats)
+                    scan_time = 0.0
+                    htmls.append(html_src)
+                else:
+                    (page_images, page_nav, parts, cached, scan_time,
+                     minified) = next(results)
+                    if minified is not None:
+                        stats.add_minified(*minified)
+                    if dedup is not None:
+                        aliases = dedup.get_aliases(page_images)
+                        if aliases:
+                            page_images = [
+                                aliases.get(src, src) for src in page_images]
+                            parts = [
+                                (part_name,
+                                 _rewrite_image_srcs(payload, aliases))
+                                for part_name, payload in parts
+                            ]
+                    if self.scan_cache is not None:
+                        self.scan_cache.count(cached)
+                    for part_name, payload in parts:
+                        if deferred is not None:
+                            deferred.append((_path(part_name), payload))
+                        else:
+                            zip_obj.writestr(
+                                _path(part_name), payload, _compression)
+                        htmls.append(part_name)
+                    del parts, payload
+                images.update(page_images)
                 nav_points.append(page_nav)
-        zip_obj.writestr(
-            "META-INF/container.xml",
-            self._container_xml_template.render(), ZIP_STORED)
-        zip_obj.write("style.css", "OEBPS/style.css", _compression)
+                stats.headings += len(page_nav)
+                stats.add_source(
+                    html_src, time.perf_counter() - start, scan_time)
         found_webp = [False]
         images0 = [
                 {
@@ -206,6 +858,9 @@ class EbookMaker:
                      ),
                     },
                 ]
+        if dedup is not None:
+            images.discard(cover_image_fn)
+            stats.duplicate_images = dedup.duplicates
         images = sorted(list(images))
         images1 = [
                 {'id': 'image' + str(idx), 'href': fn,
@@ -215,152 +870,109 @@ class EbookMaker:
                         )}
                 for idx, fn in enumerate(images)
                 ]
-        for img in images + [cover_image_fn]:
-            zip_obj.write(img, _path(img))
-        if found_webp[0]:
-            imgfn = 'onepixel.png'
-            zip_obj.write(
-                self._templates_dirname + '/' + imgfn, _path(imgfn)
+        stats.images = len(set(images + [cover_image_fn]))
+        htmls0 = [
+            {'id': 'item'+str(idx), 'href': fn}
+            for idx, fn in enumerate(['cover.xhtml', 'toc.xhtml', ] + htmls)
+        ]
+        if self._validate:
+            problems = validate_book(
+                manifest=_get_manifest(
+                    images0 + images1, found_webp[0], htmls0),
+                guide=json_data.get('guide'),
+                nav_points=nav_points,
+                exists=provider.exists,
             )
-        for html_src in htmls:
-            if html_src.endswith(".xhtml"):
-                with open(html_src, 'rt') as file_handle:
-                    mytext = file_handle.read()
-                mytext = STRIP_DOCTYPE__REGEX.sub(
-                    "\\1", mytext, 0
+            if problems:
+                raise ValidationError(problems)
+            _write_head()
+            for member, payload in deferred:
+                zip_obj.writestr(member, payload, _compression)
+            del deferred
+        with stats.phase('render'):
+            zip_obj.writestr(
+                "META-INF/container.xml",
+                templates.container_xml_template.render(), ZIP_STORED)
+        with stats.phase('images'):
+            style = _read_bytes("style.css")
+            if self._minify:
+                size = len(style)
+                style = minify_css(style.decode('utf-8')).encode('utf-8')
+                stats.add_minified(size, len(style))
+            zip_obj.writestr(
+                "OEBPS/style.css", style, _compression, shared=True)
+            del style
+            for img in images + [cover_image_fn]:
+                if self._should_stream(provider, img, zip_obj):
+                    stats.bytes_read += provider.size(img)
+                    with provider.open(img) as file_handle:
+                        zip_obj.writestream(
+                            _path(img), _iter_chunks(file_handle),
+                            ZIP_STORED, size=provider.size(img))
+                else:
+                    zip_obj.writestr(
+                        _path(img), _read_bytes(img), ZIP_STORED,
+                        shared=True)
+            if found_webp[0]:
+                imgfn = 'onepixel.png'
+                zip_obj.write(
+                    get_templates_dirname() + '/' + imgfn, _path(imgfn)
                 )
-                zip_obj.writestr(_path(html_src), mytext, _compression)
+                stats.inputs.append(get_templates_dirname() + '/' + imgfn)
+
+        def _write_rendered(basefn, template, **kwargs):
+            """Render template into the member basefn as a stream.
+
+            With compression threads, the rendered text is joined and
+            compressed in their pool instead, trading its memory for
+            keeping the main thread free.
+            """
+            chunks = (
+                chunk.encode('utf-8') for chunk in
+                _normalize_trailing_newlines(
+                    _join_chunks(template.generate(**kwargs)))
+            )
+            if zip_obj.threaded:
+                zip_obj.writestr(_path(basefn), b''.join(chunks), _compression)
             else:
-                zip_obj.write(html_src, _path(html_src), _compression)
+                zip_obj.writestream(_path(basefn), chunks, _compression)
+        with stats.phase('render'):
+            uid_url = json_data['identifier']['value']
+
+            _write_rendered(
+                "content.opf", templates.content_opf_template,
+                author_sorted=json_data['authors'][0]['sort'],
+                author_name=json_data['authors'][0]['name'],
+                found_webp=found_webp[0],
+                images0=images0,
+                images1=images1,
+                modified_date=modified_date,
+                dc_rights=json_data['rights'],
+                language=json_data['language'],
+                publisher=json_data['publisher'],
+                title=json_data['title'],
+                url=uid_url,
+                guide=(json_data['guide'] if 'guide' in json_data else None),
+                htmls0=htmls0,
+            )
 
-        def _writestr(basefn, content_text):
-            zip_obj.writestr(
-                "OEBPS/" + basefn,
-                RE.sub("\n", content_text),
-                _compression
+            nav_points_text, nav_points_xhtml, toc_html_text = \
+                _render_nav_points(nav_points)
+            _write_rendered(
+                "toc.ncx", templates.toc_ncx_template,
+                author_name=json_data['authors'][0]['name'],
+                navPoints_text=nav_points_text,
+                title=json_data['title'],
+                url=uid_url,
             )
-        uid_url = json_data['identifier']['value']
-
-        content_text = self._content_opf_template.render(
-            author_sorted=json_data['authors'][0]['sort'],
-            author_name=json_data['authors'][0]['name'],
-            found_webp=found_webp[0],
-            images0=images0,
-            images1=images1,
-            modified_date=(
-                json_data['modified_date']
-                if ('modified_date' in json_data) else "2021-01-01T00:00:01Z"),
-            dc_rights=json_data['rights'],
-            language=json_data['language'],
-            publisher=json_data['publisher'],
-            title=json_data['title'],
-            url=uid_url,
-            guide=(json_data['guide'] if 'guide' in json_data else None),
-            htmls0=[
-                {'id': 'item'+str(idx), 'href': fn}
-                for idx, fn in enumerate(
-                    ['cover.xhtml', 'toc.xhtml', ] + htmls
-                )
-                ],
-        )
-        _writestr("content.opf", content_text)
-
-        def get_nav_points(counter, nav_points, start_idx, level):
-            idx = start_idx
-            ret = Markup('')
-            ret_xhtml = Markup('')
-            prefix = (INDENT_STEP * (level-1))
-            while idx < len(nav_points):
-                rec = nav_points[idx]
-                if rec['level'] < level:
-                    return ret, idx
-                href = rec['href']
-                label = rec['label']
-                counter.toc_html_text += Markup(
-                    '<p style="text-indent: {level}em;">' +
-                    '<a href="{href}">{label}</a></p>\n' +
-                    '').format(
-                        level=level,
-                        label=label,
-                        href=href
-                    )
-
-                temp_ret_idx = counter.get_idx()
-                ret += Markup(
-                    '{p}<navPoint id="nav{idx}" playOrder="{idx}">\n' +
-                    '{p}{indent}<navLabel><text>{label}</text></navLabel>\n' +
-                    '{p}{indent}<content src="{href}"/>\n' +
-                    ''
-                ).format(
-                    p=prefix,
-                    indent=INDENT_STEP,
-                    label=label,
-                    href=href, idx=temp_ret_idx)
-                ret_xhtml += Markup(
-                    '{p}<li>\n' +
-                    '{p}<a href="{href}">{label}</a>\n' +
-                    ''
-                ).format(
-                    p=prefix,
-                    indent=INDENT_STEP,
-                    label=label,
-                    href=href, idx=temp_ret_idx)
-                next_idx = idx + 1
-                if next_idx < len(nav_points):
-                    next_level = nav_points[next_idx]['level']
-                    if next_level > level:
-                        ret_xhtml += Markup('<ol>')
-                        sub_ret, sub_xhtml, next_idx = get_nav_points(
-                            counter,
-                            nav_points,
-                            next_idx, next_level)
-                        ret += sub_ret
-                        ret_xhtml += sub_xhtml
-                        ret_xhtml += Markup('</ol>')
-                idx = next_idx
-                ret += Markup(
-                    '{p}</navPoint>\n'
-                ).format(p=prefix)
-                ret_xhtml += Markup(
-                    '{p}</li>\n'
-                ).format(p=prefix)
-            return ret, ret_xhtml, idx
-        nav_points_text = Markup('')
-        nav_points_xhtml = Markup('')
-        counter = MyCounter()
-        for file_nav_points in nav_points:
-            counter.toc_html_text += Markup(
-                '<div style="margin-top: 1em;">\n'
+            _write_rendered(
+                "nav.xhtml", templates.nav_xhtml_template,
+                author_name=json_data['authors'][0]['name'],
+                nav_html_text=nav_points_xhtml,
+                title=json_data['title'],
+                url=uid_url,
             )
-            if len(file_nav_points):
-                min_level = min([x['level'] for x in file_nav_points])
-                if min_level > 1:
-                    delta = min_level - 1
-                    for x in file_nav_points:
-                        x['level'] -= delta
-
-            nav_ncx, nav_xhtml, idx = get_nav_points(
-                counter, file_nav_points, 0, 1
+            _write_rendered(
+                "toc.xhtml", templates.toc_html_template,
+                toc_html_text=toc_html_text,
             )
-            nav_points_text += nav_ncx
-            nav_points_xhtml += nav_xhtml
-            counter.toc_html_text += Markup('</div>\n')
-        content_text = self._toc_ncx_template.render(
-            author_name=json_data['authors'][0]['name'],
-            navPoints_text=nav_points_text,
-            title=json_data['title'],
-            url=uid_url,
-        )
-        _writestr("toc.ncx", content_text)
-        content_xhtml = self._nav_xhtml_template.render(
-            author_name=json_data['authors'][0]['name'],
-            nav_html_text=nav_points_xhtml,
-            title=json_data['title'],
-            url=uid_url,
-        )
-        _writestr("nav.xhtml", content_xhtml)
-        content_text = self._toc_html_template.render(
-            toc_html_text=counter.toc_html_text,
-        )
-        _writestr("toc.xhtml", content_text)
-        zip_obj.close()
@@ -0,0 +1,518 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.archive - write the members of the EPUB zip archive in order.
+
+All members get the same timestamp, so that building the same book twice
+results in the same archive.  Optionally, the DEFLATE compression of the
+members is done by a thread pool (zlib releases the GIL) and the
+precompressed streams are appended to the archive in the original order.
+
+An existing archive may also be reused: members whose CRC and size did not
+change have their compressed bytes copied over as they are.
+
+Finally, an AssetCache shared by several archives keeps the compressed
+streams of the files they have in common (style sheets, images), so that
+a batch of books does not compress the same file twice.
+"""
+
+import hashlib
+import os
+import secrets
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
+from zipfile import ZIP64_LIMIT
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from zipfile import ZipFile
+from zipfile import ZipInfo
+from zipfile import sizeFileHeader
+from zipfile import structFileHeader
+
+from rebookmaker.compression import ZOPFLI_ENCODER
+from rebookmaker.compression import deflate
+
+# The offsets of the name and the extra field lengths in a local header.
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+DEFAULT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def get_date_time(timestamp):
+    """Convert an ISO 8601 timestamp such as "2021-01-01T00:00:01Z"
+
+    to a zip date_time tuple.
+    """
+    try:
+        ret = time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")[:6]
+    except (TypeError, ValueError):
+        return DEFAULT_DATE_TIME
+    if ret < DEFAULT_DATE_TIME:
+        return DEFAULT_DATE_TIME
+    return ret
+
+
+def _compress(data, compress_type, method=None):
+    """Return the compressed stream of data as zipfile would write it.
+
+    method is the (compress_type, level, encoder) of a compression
+    profile, if there is one.
+    """
+    if compress_type == ZIP_STORED:
+        return data
+    if method is not None:
+        return deflate(data, method[1], method[2])
+    if compress_type != ZIP_DEFLATED:
+        raise ValueError(
+            "Unsupported compression type '{}'".format(compress_type))
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+DEFAULT_ASSET_CACHE_MAX_SIZE = (64 << 20)
+
+
+class AssetCache:
+
+    """An in-memory LRU cache of the compressed streams of shared files
+
+    keyed by the digest of their contents and by the compression
+    type.  It can be shared between threads, and a file which is being
+    compressed for one of them is not compressed again for the others.
+    """
+
+    def __init__(self, max_size=DEFAULT_ASSET_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._size = 0
+        self._entries = {}
+        # key -> the Future of the entry which is being compressed.
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, data, compress_type):
+        return (hashlib.sha256(data).digest(), compress_type)
+
+    def get(self, key):
+        """Return the (crc, compressed) pair stored under key, a Future
+
+        of it if it is being compressed, or None.  After None, the
+        caller must compress it and call put() (or discard() if that
+        failed), and the Future of the others is then set to the pair
+        (or to None).
+        """
+        with self._lock:
+            ret = self._entries.pop(key, None)
+            if ret is None:
+                ret = self._in_flight.get(key)
+                if ret is None:
+                    self._in_flight[key] = Future()
+                    self.misses += 1
+                    return None
+            else:
+                # Move it to the most recently used end.
+                self._entries[key] = ret
+            self.hits += 1
+            return ret
+
+    def put(self, key, crc, compressed):
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+            if key not in self._entries and len(compressed) <= self.max_size:
+                self._entries[key] = (crc, compressed)
+                self._size += len(compressed)
+                while self._size > self.max_size:
+                    old_key = next(iter(self._entries))
+                    self._size -= len(self._entries.pop(old_key)[1])
+        if future is not None:
+            future.set_result((crc, compressed))
+
+    def discard(self, key):
+        """Give up compressing key after get() returned None."""
+        with self._lock:
+            future = self._in_flight.pop(key, None)
+        if future is not None:
+            future.set_result(None)
+
+
+def _compress_asset(asset_cache, asset_key, data, compress_type, method):
+    """Compress the shared data and put it into asset_cache.
+
+    Returns the (crc, compressed) pair.
+    """
+    try:
+        ret = (zlib.crc32(data), _compress(data, compress_type, method))
+    except BaseException:
+        asset_cache.discard(asset_key)
+        raise
+    asset_cache.put(asset_key, *ret)
+    return ret
+
+
+def is_path(output):
+    """Whether output is a filesystem path rather than a file object."""
+    return isinstance(output, (str, bytes, os.PathLike))
+
+
+def _create_temp_file(output_filename):
+    """Create an empty temporary file in the directory of output_filename.
+
+    Unlike the one of tempfile.mkstemp(), its permissions are the ones
+    of an existing output, and otherwise follow the umask, like the ones
+    of a new output.  The read-only mode of an output which is hard
+    linked from the output cache is not kept.
+    """
+    dirname = os.path.dirname(output_filename) or '.'
+    while True:
+        temp_fn = os.path.join(
+            dirname, '.tmp-' + secrets.token_hex(8) + '.epub')
+        try:
+            with open(temp_fn, 'xb'):
+                break
+        except FileExistsError:
+            continue
+    try:
+        if os.stat(output_filename).st_nlink == 1:
+            shutil.copymode(output_filename, temp_fn)
+    except FileNotFoundError:
+        pass
+    return temp_fn
+
+
+class ArchiveWriter:
+
+    """Write the members of a zip archive, in order.
+
+    output_filename is either a path or a writable binary file object,
+    which may be non-seekable (e.g. a pipe or a socket).  File objects
+    are not closed.  A path is written into a temporary file next to it,
+    which replaces it on close(), so a failed build (see abort()) never
+    leaves a truncated output behind, and an output which is a hard link
+    (e.g. to the output cache) is not written through.
+
+    threads is the number of threads used to compress the members
+    ahead of writing them.  If it is None, every member is compressed
+    by zipfile as it is written.
+
+    If reuse_previous is true and output_filename is an existing
+    archive, unchanged members are copied from the old one.
+
+    asset_cache is an optional AssetCache for the compressed files
+    written using write().
+
+    If keep_unchanged is true and output_filename is an existing file
+    with the same contents as the new archive, it is left untouched
+    (including its mtime).
+
+    profile is an optional rebookmaker.compression.CompressionProfile,
+    which overrides the compress_type of the members, and stores those
+    which do not shrink.
+    """
+
+    def __init__(self, output_filename, date_time=DEFAULT_DATE_TIME,
+                 threads=None, reuse_previous=False, asset_cache=None,
+                 keep_unchanged=False, profile=None):
+        self._output_filename = output_filename
+        self._profile = profile
+        # The number of members stored because they did not shrink.
+        self.stored_uncompressible = 0
+        self._asset_cache = asset_cache
+        self._temp_fn = None
+        self._previous = None
+        exists = (is_path(output_filename) and
+                  os.path.isfile(output_filename))
+        if reuse_previous and exists:
+            try:
+                self._previous = ZipFile(output_filename, 'r')
+            except (OSError, ValueError):
+                self._previous = None
+        self._keep_unchanged = (keep_unchanged and exists)
+        # Whether close() kept the existing output_filename.
+        self.unchanged = False
+        if is_path(output_filename):
+            self._temp_fn = _create_temp_file(output_filename)
+        # The number of members which were copied from the old archive.
+        self.reused = 0
+        # The size of the archive, which is known after close().
+        self.size = None
+        self._zip_obj = ZipFile(
+            (self._temp_fn or output_filename), 'w')
+        self._start_offset = self._zip_obj.start_dir
+        self._date_time = date_time
+        self._executor = None
+        self._pending = deque()
+        self._max_pending = 0
+        if threads is not None and threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            self._max_pending = 2 * threads
+        # zipfile writes the members of non-seekable outputs with data
+        # descriptors, so compress them ourselves and write their sizes
+        # up front instead.
+        self._append_compressed = (
+            self._executor is not None or not self._zip_obj._seekable)
+
+    def _make_info(self, arcname, data, compress_type):
+        zinfo = ZipInfo(filename=arcname, date_time=self._date_time)
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(data)
+        return zinfo
+
+    def writestr(self, arcname, data, compress_type=ZIP_STORED,
+                 shared=False):
+        """Write data (a str or bytes) as the member arcname.
+
+        shared marks files which other books are likely to contain as
+        well, whose compressed streams are kept in the asset cache.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        method = None
+        if self._profile is not None:
+            method = self._profile.get_method(arcname)
+            compress_type = method[0]
+        zinfo = self._make_info(arcname, data, compress_type)
+        if self._previous is not None and self._reuse(zinfo, data):
+            return
+        asset_key = None
+        if (shared and self._asset_cache is not None and
+                compress_type != ZIP_STORED):
+            asset_key = self._asset_cache.get_key(
+                data, (compress_type if method is None else method))
+            cached = self._asset_cache.get(asset_key)
+            if cached is not None:
+                self._pending.append(
+                    (zinfo, data, cached, (compress_type, method)))
+                self._write_ahead()
+                return
+        if not self._append_compressed and asset_key is None and \
+                method is None:
+            self._zip_obj.writestr(zinfo, data, compress_type)
+            return
+        # The shared files are put into the asset cache as soon as they
+        # are compressed, rather than when they are written, so builds
+        # which wait for each other's files do not deadlock.
+        if compress_type == ZIP_STORED:
+            compressed = data
+        elif asset_key is not None:
+            if self._executor is None:
+                compressed = _compress_asset(
+                    self._asset_cache, asset_key, data, compress_type,
+                    method)
+            else:
+                compressed = self._executor.submit(
+                    _compress_asset, self._asset_cache, asset_key, data,
+                    compress_type, method)
+        elif self._executor is None:
+            compressed = _compress(data, compress_type, method)
+        else:
+            compressed = self._executor.submit(
+                _compress, data, compress_type, method)
+        self._pending.append((zinfo, data, compressed, None))
+        self._write_ahead()
+
+    @property
+    def can_stream(self):
+        """Whether writestream() may be used (the output is seekable)."""
+        return self._zip_obj._seekable
+
+    @property
+    def threaded(self):
+        """Whether writestr() compresses the members in a thread pool."""
+        return self._executor is not None
+
+    def writestream(self, arcname, chunks, compress_type=ZIP_STORED,
+                    size=0, shared=False):
+        """Write the bytes in the iterable chunks as the member arcname.
+
+        Only one chunk is kept in memory at a time.  size is an estimate
+        of the total size, for deciding whether the member needs the
+        ZIP64 extensions.  The member is not kept in the asset cache, and
+        a profile's storing of members which do not shrink is not applied
+        to it.  The chunks are joined and passed to writestr() if the
+        output is not seekable, if the member may be reused from the
+        previous archive or if it needs the zopfli encoder.  Unlike
+        writestr(), it compresses on the calling thread.
+        """
+        method = None
+        if self._profile is not None:
+            method = self._profile.get_method(arcname)
+        if (not self.can_stream or self._previous is not None or
+                (method is not None and method[2] == ZOPFLI_ENCODER)):
+            self.writestr(
+                arcname, b''.join(chunks), compress_type, shared=shared)
+            return
+        zinfo = ZipInfo(filename=arcname, date_time=self._date_time)
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = size
+        if method is not None:
+            compress_type, zinfo._compresslevel = method[:2]
+        zinfo.compress_type = compress_type
+        # Keep the members in order.
+        while self._pending:
+            self._write_pending()
+        with self._zip_obj.open(zinfo, 'w') as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+
+    def _write_ahead(self):
+        while len(self._pending) > self._max_pending:
+            self._write_pending()
+
+    def _reuse(self, zinfo, data):
+        """Copy the compressed bytes of zinfo from the old archive
+
+        if they are still up to date.  Returns whether they were.
+        """
+        try:
+            old = self._previous.getinfo(zinfo.filename)
+        except KeyError:
+            return False
+        # A profile stores the members which do not shrink.
+        if ((old.compress_type != zinfo.compress_type and not (
+                self._profile is not None and
+                old.compress_type == ZIP_STORED)) or
+                old.file_size != zinfo.file_size or
+                (old.flag_bits & 0x1)):
+            return False
+        crc = zlib.crc32(data)
+        if old.CRC != crc:
+            return False
+        fp = self._previous.fp
+        fp.seek(old.header_offset)
+        header = struct.unpack(structFileHeader, fp.read(sizeFileHeader))
+        fp.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH],
+                os.SEEK_CUR)
+        compressed = fp.read(old.compress_size)
+        if len(compressed) != old.compress_size:
+            return False
+        # Keep the members in order.
+        while self._pending:
+            self._write_pending()
+        zinfo.CRC = crc
+        zinfo.compress_type = old.compress_type
+        zinfo.compress_size = old.compress_size
+        self._append_raw(zinfo, compressed)
+        self.reused += 1
+        return True
+
+    def write(self, filename, arcname, compress_type=ZIP_STORED):
+        """Write the contents of the file filename as the member arcname."""
+        with open(filename, 'rb') as file_handle:
+            data = file_handle.read()
+        self.writestr(arcname, data, compress_type, shared=True)
+
+    def _write_pending(self):
+        """Write the oldest pending member.
+
+        Its compressed bytes are either ready, a (crc, compressed) pair
+        or a Future of either.  compress_args is the (compress_type,
+        method) for compressing a file which another build failed to
+        put into the asset cache.
+        """
+        zinfo, data, compressed, compress_args = self._pending.popleft()
+        if isinstance(compressed, Future):
+            compressed = compressed.result()
+            if compressed is None:
+                compressed = _compress(data, *compress_args)
+        if isinstance(compressed, tuple):
+            crc, compressed = compressed
+        else:
+            crc = zlib.crc32(data)
+        if self._profile is not None and \
+                zinfo.compress_type != ZIP_STORED and \
+                len(compressed) >= len(data):
+            zinfo.compress_type = ZIP_STORED
+            compressed = data
+            self.stored_uncompressible += 1
+        zinfo.CRC = crc
+        zinfo.compress_size = len(compressed)
+        self._append_raw(zinfo, compressed)
+
+    def _append_raw(self, zinfo, compressed):
+        """Append an already compressed member to the archive.
+
+        This mirrors what ZipFile.writestr() does, so the resulting
+        headers are the same.
+        """
+        zip_obj = self._zip_obj
+        with zip_obj._lock:
+            zip_obj._writecheck(zinfo)
+            zip_obj._didModify = True
+            if zip_obj._seekable:
+                zip_obj.fp.seek(zip_obj.start_dir)
+            zinfo.header_offset = zip_obj.fp.tell()
+            zip64 = zip_obj._allowZip64 and (
+                zinfo.file_size * 1.05 > ZIP64_LIMIT)
+            zip_obj.fp.write(zinfo.FileHeader(zip64))
+            zip_obj.fp.write(compressed)
+            zip_obj.filelist.append(zinfo)
+            zip_obj.NameToInfo[zinfo.filename] = zinfo
+            zip_obj.start_dir = zip_obj.fp.tell()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._previous is not None:
+            self._previous.close()
+            self._previous = None
+
+    def infolist(self):
+        """Return the ZipInfo-s of the members written so far."""
+        return list(self._zip_obj.filelist)
+
+    def close(self):
+        """Write the remaining members and close the archive."""
+        while self._pending:
+            self._write_pending()
+        self._shutdown()
+        file_handle = self._zip_obj.fp
+        self._zip_obj.close()
+        if is_path(self._output_filename):
+            self.size = os.path.getsize(
+                self._temp_fn or self._output_filename)
+        else:
+            self.size = file_handle.tell() - self._start_offset
+        if self._temp_fn is not None:
+            if self._keep_unchanged:
+                import filecmp
+
+                self.unchanged = filecmp.cmp(
+                    self._temp_fn, self._output_filename, shallow=False)
+            if self.unchanged:
+                os.unlink(self._temp_fn)
+            else:
+                os.replace(self._temp_fn, self._output_filename)
+            self._temp_fn = None
+
+    def abort(self):
+        """Close the archive after a failure.
+
+        The temporary file is deleted, so an existing output is kept as
+        it was.  The central directory is not written into file objects,
+        so they are not mistaken for complete archives.
+        """
+        self._pending.clear()
+        self._shutdown()
+        try:
+            self._zip_obj._didModify = False
+            self._zip_obj.close()
+        finally:
+            if self._temp_fn is not None:
+                os.unlink(self._temp_fn)
+                self._temp_fn = None
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.batch - build many EPUBs using one warm EbookMaker.
+
+A batch manifest is a JSON file with a list of jobs such as:
+
+    [
+        {"json": "humanity.json", "output": "humanity.epub",
+         "directory": "humanity-build"},
+        ...
+    ]
+
+"output" defaults to the "json" path with an .epub extension and
+"directory", which is where the book's sources are looked up, defaults
+to the current directory.  Relative paths are relative to the directory
+of the manifest.
+"""
+
+import json
+import os
+
+from rebookmaker import EbookMaker
+from rebookmaker.archive import AssetCache
+
+
+class BatchJob:
+
+    """A single book to build."""
+
+    def __init__(self, json_fn, output_filename=None, directory=None):
+        self.json_fn = os.path.abspath(json_fn)
+        if output_filename is None:
+            output_filename = os.path.splitext(self.json_fn)[0] + '.epub'
+        self.output_filename = os.path.abspath(output_filename)
+        self.directory = os.path.abspath(
+            os.getcwd() if directory is None else directory)
+
+    def __repr__(self):
+        return 'BatchJob({!r}, {!r}, {!r})'.format(
+            self.json_fn, self.output_filename, self.directory)
+
+
+def read_jobs(fn):
+    """Read the jobs of the manifest fn.
+
+    If fn is a book definition rather than a manifest, a single job
+    for building it is returned.
+    """
+    with open(fn, 'rb') as file_handle:
+        data = json.load(file_handle)
+    if isinstance(data, dict):
+        return [BatchJob(fn)]
+    base_dir = os.path.dirname(os.path.abspath(fn))
+
+    def _path(path):
+        if path is None:
+            return None
+        return os.path.join(base_dir, path)
+    return [
+        BatchJob(
+            json_fn=_path(job['json']),
+            output_filename=_path(job.get('output')),
+            directory=(_path(job['directory']) if 'directory' in job
+                       else None),
+        )
+        for job in data
+    ]
+
+
+def _build_job(maker, job, incremental):
+    """Build job using maker and return None or an error message."""
+    try:
+        maker.make_epub(
+            job.json_fn, job.output_filename, incremental=incremental,
+            base_dir=job.directory)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+def make_shared_maker(**maker_kwargs):
+    """Return an EbookMaker for building many books, from many threads."""
+    return EbookMaker(asset_cache=AssetCache(), **maker_kwargs)
+
+
+def build_batch(jobs, workers=1, incremental=False, **maker_kwargs):
+    """Build all of jobs and return the list of their errors (or Nones).
+
+    maker_kwargs are passed to EbookMaker.  With workers > 1, the books
+    are built by a thread pool which shares a single EbookMaker and
+    AssetCache.  The caches are pruned once, after all the builds.
+    """
+    jobs = list(jobs)
+    maker = make_shared_maker(auto_prune=False, **maker_kwargs)
+    if workers < 2 or len(jobs) < 2:
+        errors = [_build_job(maker, job, incremental) for job in jobs]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(
+                lambda job: _build_job(maker, job, incremental), jobs))
+    maker.prune_caches()
+    return errors
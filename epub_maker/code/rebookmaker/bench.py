@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.bench - benchmark EbookMaker on synthetic books.
+
+generate_corpus() writes a book with a configurable number and size of
+chapters, headings and images, and run_benchmark() builds it with every
+compression and records the wall time, the peak memory (as traced by
+tracemalloc) and the size of the output.  The results are plain JSON
+data, so runs can be saved and compared using check_regressions().
+
+See "rebookmaker bench --help".
+"""
+
+import os
+import random
+import time
+import tracemalloc
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+BENCH_RESULTS_VERSION = 1
+
+COMPRESSIONS = {
+    'ZIP_STORED': ZIP_STORED,
+    'ZIP_DEFLATED': ZIP_DEFLATED,
+}
+
+# The measurements which check_regressions() compares.
+METRICS = ('wall_time', 'peak_memory', 'output_size',)
+
+_WORDS = (
+    "the quick brown fox jumps over a lazy dog while shlomi writes yet "
+    "another screenplay about humanity and selina mandrake"
+).split()
+
+_XHTML_HEADER = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en-GB">
+<head>
+<title>{title}</title>
+<link rel="stylesheet" href="style.css" />
+</head>
+<body>
+'''
+
+_XHTML_FOOTER = '''</body>
+</html>
+'''
+
+_IMAGE_MAGIC = {
+    'jpg': b'\xff\xd8\xff\xe0',
+    'png': b'\x89PNG\r\n\x1a\n',
+    'webp': b'RIFF\0\0\0\0WEBPVP8 ',
+}
+
+
+class CorpusSpec:
+
+    """The parameters of a synthetic book.
+
+    chapters - the number of chapter sources (globbed as
+    "chapters/chapter-*.xhtml").
+    chapter_size - the approximate size of a chapter in bytes.
+    heading_depth - the deepest heading level (1-6), which is also the
+    TOC depth.
+    headings_per_chapter - the number of headings in every chapter.
+    images - the number of distinct images, cycling through image_types.
+    image_size - the size of an image in bytes.
+    """
+
+    def __init__(self, chapters=50, chapter_size=(20 << 10), heading_depth=3,
+                 headings_per_chapter=10, images=10, image_size=(16 << 10),
+                 image_types=('jpg', 'png', 'webp',), seed=0):
+        self.chapters = chapters
+        self.chapter_size = chapter_size
+        self.heading_depth = heading_depth
+        self.headings_per_chapter = headings_per_chapter
+        self.images = images
+        self.image_size = image_size
+        self.image_types = tuple(image_types)
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self), image_types=list(self.image_types))
+
+
+def _paragraph(rand, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rand.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return '<p>' + ' '.join(words) + '</p>\n'
+
+
+def _chapter(rand, spec, idx, image_names):
+    parts = [_XHTML_HEADER.format(title='Chapter {}'.format(idx))]
+    headings = max(spec.headings_per_chapter, 1)
+    paragraph_size = max(spec.chapter_size // headings - 64, 16)
+    for heading_idx in range(headings):
+        level = (1 if heading_idx == 0
+                 else 2 + (heading_idx - 1) % max(spec.heading_depth - 1, 1))
+        level = min(level, spec.heading_depth)
+        parts.append('<h{0} id="c{1}-h{2}">Chapter {1} part {2}</h{0}>\n'
+                     .format(level, idx, heading_idx))
+        if image_names and heading_idx == 0:
+            parts.append('<p><img src="{}" alt="" /></p>\n'.format(
+                image_names[idx % len(image_names)]))
+        parts.append(_paragraph(rand, paragraph_size))
+    parts.append(_XHTML_FOOTER)
+    return ''.join(parts)
+
+
+def generate_corpus(directory, spec=None):
+    """Write the synthetic book of the CorpusSpec spec into directory.
+
+    Returns its JSON data (whose sources are relative to directory).
+    """
+    if spec is None:
+        spec = CorpusSpec()
+    rand = random.Random(spec.seed)
+    os.makedirs(os.path.join(directory, 'chapters'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'images'), exist_ok=True)
+
+    def _write(name, data):
+        with open(os.path.join(directory, name), 'wb') as file_handle:
+            file_handle.write(data)
+
+    def _image_data(image_type):
+        return (_IMAGE_MAGIC[image_type] + bytes(
+            rand.getrandbits(8) for _ in range(spec.image_size)))
+    image_names = []
+    for idx in range(spec.images):
+        image_type = spec.image_types[idx % len(spec.image_types)]
+        name = 'images/image-{:04d}.{}'.format(idx, image_type)
+        _write(name, _image_data(image_type))
+        image_names.append(name)
+    _write('cover.png', _image_data('png'))
+    _write('style.css', b'body { margin: 0; }\nh1 { text-align: center; }\n')
+    for idx in range(spec.chapters):
+        _write(
+            'chapters/chapter-{:05d}.xhtml'.format(idx),
+            _chapter(rand, spec, idx, image_names).encode('utf-8'))
+    return {
+        'authors': [{'name': 'Bench Mark', 'sort': 'Mark, Bench'}],
+        'contents': [
+            {'type': 'toc', 'source': 'toc.html'},
+            {'type': 'text', 'source': 'chapters/chapter-*.xhtml'},
+        ],
+        'cover': 'cover.png',
+        'identifier': {'scheme': 'URL', 'value': 'https://example.com/'},
+        'language': 'en-GB',
+        'publisher': 'rebookmaker.bench',
+        'rights': 'CC0',
+        'title': 'A Synthetic Book',
+        'toc': {'depth': spec.heading_depth, 'parse': ['text'],
+                'generate': {'title': 'Index'}},
+    }
+
+
+def run_benchmark(json_data, base_dir, compressions=None, repeat=3,
+                  **maker_kwargs):
+    """Build the book json_data with each of the compressions names.
+
+    The wall time is the best of repeat builds, and the peak memory is
+    measured by a separate build under tracemalloc.  maker_kwargs are
+    passed to EbookMaker.  Returns a dict of compression name to a dict
+    of the METRICS.
+    """
+    from rebookmaker import EbookMaker
+
+    if compressions is None:
+        compressions = sorted(COMPRESSIONS)
+    output_fn = os.path.join(base_dir, 'bench-output.epub')
+    results = {}
+    for name in compressions:
+        maker = EbookMaker(
+            compression=COMPRESSIONS[name], base_dir=base_dir,
+            **maker_kwargs)
+        wall_times = []
+        for _ in range(max(repeat, 1)):
+            start = time.perf_counter()
+            maker.make_epub_from_data(json_data, output_fn)
+            wall_times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            maker.make_epub_from_data(json_data, output_fn)
+            _current, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results[name] = {
+            'wall_time': min(wall_times),
+            'peak_memory': peak_memory,
+            'output_size': os.path.getsize(output_fn),
+        }
+    os.unlink(output_fn)
+    return results
+
+
+def make_report(spec, results):
+    """Return the JSON-serializable report of the benchmark results."""
+    return {
+        'version': BENCH_RESULTS_VERSION,
+        'corpus': spec.as_dict(),
+        'results': results,
+    }
+
+
+def check_regressions(report, baseline, tolerance=0.2):
+    """Compare report against the baseline report.
+
+    Returns a list of messages about the METRICS which are more than
+    tolerance (a fraction) above their value in baseline.
+    """
+    regressions = []
+    for name, metrics in sorted(report['results'].items()):
+        base_metrics = baseline.get('results', {}).get(name)
+        if base_metrics is None:
+            continue
+        for metric in METRICS:
+            if metric not in base_metrics:
+                continue
+            budget = base_metrics[metric] * (1 + tolerance)
+            if metrics[metric] > budget:
+                regressions.append(
+                    "{}: {} is {:.6g} which exceeds the budget of {:.6g}"
+                    .format(name, metric, metrics[metric], budget))
+    return regressions
@@ -0,0 +1,481 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.cache - persistent caches kept in a directory.
+
+Entries are written into temporary files which are then renamed into
+place, so several builds may share a cache directory at once.  A reader
+which loses a race against an eviction simply gets a miss.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Bump it whenever the format of the scan results changes.
+SCAN_CACHE_VERSION = 1
+
+DEFAULT_SCAN_CACHE_MAX_SIZE = (256 << 20)
+
+
+class _DirCache:
+
+    """A directory of entries with a size bounded LRU eviction.
+
+    The mtime of an entry is updated whenever it is used, and the
+    least recently used entries are deleted first.  maybe_prune() only
+    walks the directory when a running total of the sizes, which starts
+    from a single walk, exceeds max_size, so it is cheap to call after
+    every build.  The entries stored by other processes are only counted
+    by the next walk.
+    """
+
+    suffix = ''
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        # The running total of the sizes of the entries, or None before
+        # the first walk.
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _store(self, key, write_cb, mode=None):
+        """Atomically store the entry key written by write_cb(file_handle).
+
+        If mode is not None, these are the permissions of its file.
+        """
+        path = self._entry_path(key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, temp_fn = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file_handle:
+                write_cb(file_handle)
+            if mode is not None:
+                os.chmod(temp_fn, mode)
+            size = os.stat(temp_fn).st_size
+            os.replace(temp_fn, path)
+        except BaseException:
+            try:
+                os.unlink(temp_fn)
+            except OSError:
+                pass
+            raise
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+        return path
+
+    def _entries(self):
+        ret = []
+        for dirpath, _dirnames, filenames in os.walk(self.cache_dir):
+            for fn in filenames:
+                if fn.startswith('.tmp-') or not fn.endswith(self.suffix):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                ret.append((st.st_mtime, st.st_size, path))
+        return ret
+
+    def stats(self):
+        """Return a dict with the number of entries and their total size."""
+        entries = self._entries()
+        return {
+            'entries': len(entries),
+            'size': sum(size for _mtime, size, _path in entries),
+            'max_size': self.max_size,
+        }
+
+    def prune(self, max_size=None):
+        """Evict the least recently used entries above max_size.
+
+        Returns the number of deleted entries.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _path in entries)
+        deleted = 0
+        for _mtime, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            deleted += 1
+        with self._size_lock:
+            self._size = total
+        return deleted
+
+    def maybe_prune(self):
+        """Prune the entries if their running total exceeds max_size.
+
+        Returns the number of deleted entries.
+        """
+        with self._size_lock:
+            size = self._size
+        if size is not None and size <= self.max_size:
+            return 0
+        return self.prune()
+
+
+class ScanCache(_DirCache):
+
+    """Cache of the images and the heading records of chapter sources.
+
+    The key is a digest of the contents of the source and of the
+    heading tags which are collected, so a renamed but otherwise
+    unchanged source is still a hit.
+    """
+
+    suffix = '.json'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_SCAN_CACHE_MAX_SIZE):
+        super(ScanCache, self).__init__(cache_dir, max_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, payload, h_tags, scanner):
+        """Return the cache key of the source contents payload."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [SCAN_CACHE_VERSION, scanner, list(h_tags)]).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def get(self, key, html_src):
+        """Return the (images, page_nav) of html_src or None."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as file_handle:
+                data = json.load(file_handle)
+            page_nav = [
+                (level, html_src + '#' + id_, label)
+                for level, id_, label in data['nav']
+            ]
+            images = data['images']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self._touch(path)
+        return images, page_nav
+
+    def put(self, key, html_src, images, page_nav):
+        """Store the scan results of html_src under key."""
+        prefix_len = len(html_src) + 1
+        data = json.dumps({
+            'images': list(images),
+            'nav': [
+                [level, href[prefix_len:], label]
+                for level, href, label in page_nav
+            ],
+        }).encode('utf-8')
+        self._store(key, lambda file_handle: file_handle.write(data))
+
+    def count(self, hit):
+        """Record a hit (if hit is true) or a miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def summary(self):
+        """A human readable summary of the hits and the misses."""
+        return "scan cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+DEFAULT_MEMORY_SCAN_CACHE_MAX_ENTRIES = 16384
+
+
+class MemoryScanCache(ScanCache):
+
+    """A ScanCache kept in the memory of the process (e.g. for watching).
+
+    It holds the max_entries most recently used scan results.  Its
+    cache_dir is None, so the worker processes of a parallel build do
+    not use it.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MEMORY_SCAN_CACHE_MAX_ENTRIES):
+        from collections import OrderedDict
+
+        self.cache_dir = None
+        self.max_entries = max_entries
+        self._entries_map = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, html_src):
+        with self._lock:
+            try:
+                images, nav = self._entries_map[key]
+            except KeyError:
+                return None
+            self._entries_map.move_to_end(key)
+        return list(images), [
+            (level, html_src + '#' + id_, label)
+            for level, id_, label in nav
+        ]
+
+    def put(self, key, html_src, images, page_nav):
+        prefix_len = len(html_src) + 1
+        entry = (
+            tuple(images),
+            tuple((level, href[prefix_len:], label)
+                  for level, href, label in page_nav),
+        )
+        with self._lock:
+            self._entries_map[key] = entry
+            self._entries_map.move_to_end(key)
+            while len(self._entries_map) > self.max_entries:
+                self._entries_map.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries_map),
+                'max_entries': self.max_entries,
+            }
+
+    def prune(self, max_size=None):
+        return 0
+
+    def maybe_prune(self):
+        return 0
+
+
+# Bump it whenever the format of the output cache changes.
+OUTPUT_CACHE_VERSION = 1
+
+DEFAULT_OUTPUT_CACHE_MAX_SIZE = (1 << 30)
+DEFAULT_MANIFESTS_MAX_SIZE = (16 << 20)
+
+_code_digest = None
+_code_digest_lock = threading.Lock()
+
+
+def _get_code_digest():
+    """Return a digest of the modules and the templates of rebookmaker.
+
+    It stands for the version of the code which produces the output.
+    """
+    global _code_digest
+    with _code_digest_lock:
+        if _code_digest is None:
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            digest = hashlib.sha256()
+            for dirpath, dirnames, filenames in os.walk(package_dir):
+                dirnames[:] = sorted(
+                    dn for dn in dirnames if dn != '__pycache__')
+                for fn in sorted(filenames):
+                    if fn.endswith('.pyc'):
+                        continue
+                    path = os.path.join(dirpath, fn)
+                    digest.update(
+                        os.path.relpath(path, package_dir).encode('utf-8'))
+                    digest.update(b'\0')
+                    with open(path, 'rb') as file_handle:
+                        digest.update(
+                            hashlib.sha256(file_handle.read()).digest())
+            _code_digest = digest.hexdigest()
+        return _code_digest
+
+
+class _ManifestStore(_DirCache):
+    suffix = '.json'
+
+
+class _ObjectStore(_DirCache):
+    suffix = '.epub'
+
+
+class OutputCache:
+
+    """A content-addressed cache of whole EPUBs.
+
+    A build is looked up in two steps.  The manifest key is a digest of
+    the normalized book definition, the build settings, the version of
+    rebookmaker and the expansions of the globs, and its manifest lists
+    the input files which the last such build read.  The object key
+    adds the digests of the contents of these files, and names the
+    finished EPUB.  The objects are evicted in LRU order above
+    max_size.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_OUTPUT_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._manifests = _ManifestStore(
+            os.path.join(cache_dir, 'manifests'), DEFAULT_MANIFESTS_MAX_SIZE)
+        self._objects = _ObjectStore(
+            os.path.join(cache_dir, 'objects'), max_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_manifest_key(self, json_data, settings, globs):
+        """Return the manifest key of a build.
+
+        settings is a JSON-serializable description of the options
+        which affect the output, and globs maps the glob patterns of
+        json_data to their expansions.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [OUTPUT_CACHE_VERSION, _get_code_digest(), settings, json_data,
+             sorted(globs.items())],
+            sort_keys=True, separators=(',', ':'),
+        ).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_object_key(self, manifest_key, digests):
+        """Return the object key of the (name, sha256 digest) pairs."""
+        digest = hashlib.sha256()
+        digest.update(manifest_key.encode('utf-8'))
+        for name, file_digest in digests:
+            digest.update(b'\0' + name.encode('utf-8') + b'\0')
+            digest.update(file_digest)
+        return digest.hexdigest()
+
+    def get_manifest(self, manifest_key):
+        """Return the (names, extra_inputs) of manifest_key or None."""
+        path = self._manifests._entry_path(manifest_key)
+        try:
+            with open(path, 'rb') as file_handle:
+                data = json.load(file_handle)
+            names = list(data['names'])
+            extra_inputs = list(data['extra_inputs'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self._manifests._touch(path)
+        return names, extra_inputs
+
+    def put_manifest(self, manifest_key, names, extra_inputs):
+        """Store the names read from the provider by a build.
+
+        extra_inputs are the paths of the other files it read.
+        """
+        data = json.dumps(
+            {'names': list(names), 'extra_inputs': list(extra_inputs)}
+        ).encode('utf-8')
+        self._manifests._store(
+            manifest_key, lambda file_handle: file_handle.write(data))
+
+    def restore(self, object_key, output_filename, link=False,
+                keep_unchanged=False):
+        """Put the cached EPUB of object_key at output_filename.
+
+        It is hard linked if link is true (the objects are read-only, and
+        ArchiveWriter replaces its output rather than writing into it),
+        and copied otherwise.  If keep_unchanged is true, an identical
+        existing output is left untouched.  Returns
+        None on a miss, and otherwise whether the output was unchanged.
+        """
+        import filecmp
+        import shutil
+
+        from rebookmaker.archive import _create_temp_file
+
+        path = self._objects._entry_path(object_key)
+        if not os.path.isfile(path):
+            return None
+        self._objects._touch(path)
+        try:
+            if keep_unchanged and os.path.isfile(output_filename) and \
+                    filecmp.cmp(path, output_filename, shallow=False):
+                return True
+            # A copy gets the same permissions as a built output.
+            temp_fn = _create_temp_file(output_filename)
+            try:
+                if link:
+                    os.unlink(temp_fn)
+                    os.link(path, temp_fn)
+                else:
+                    shutil.copyfile(path, temp_fn)
+                os.replace(temp_fn, output_filename)
+            except BaseException:
+                try:
+                    os.unlink(temp_fn)
+                except OSError:
+                    pass
+                raise
+        except FileNotFoundError:
+            # Evicted by a concurrent prune.
+            return None
+        return False
+
+    def put(self, object_key, output_filename):
+        """Store a read-only copy of the EPUB at output_filename under
+
+        object_key.
+        """
+        import shutil
+
+        def _write(file_handle):
+            with open(output_filename, 'rb') as input_handle:
+                shutil.copyfileobj(input_handle, file_handle)
+        self._objects._store(object_key, _write, mode=0o444)
+
+    def count(self, hit):
+        """Record a hit (if hit is true) or a miss."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Return a dict with the sizes of the objects and the manifests."""
+        return {
+            'objects': self._objects.stats(),
+            'manifests': self._manifests.stats(),
+        }
+
+    def prune(self, max_size=None):
+        """Evict the least recently used EPUBs above max_size.
+
+        Returns the number of deleted objects.
+        """
+        self._manifests.prune()
+        return self._objects.prune(max_size)
+
+    def maybe_prune(self):
+        """Prune the EPUBs and the manifests if they may exceed their
+
+        maximal sizes, see _DirCache.maybe_prune().
+        """
+        self._manifests.maybe_prune()
+        return self._objects.maybe_prune()
+
+    def summary(self):
+        """A human readable summary of the hits and the misses."""
+        return "output cache: {} hits, {} misses".format(
+            self.hits, self.misses)
@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.compression - named compression profiles.
+
+A profile maps the media type of every archive member to a deflate
+level, or to None for storing it as it is.  Members which do not shrink
+are stored (which is typical of JPEG, PNG and WebP images), and the
+"maximum" profile deflates the text with the zopfli encoder, which is an
+optional dependency ("pip install zopfli").
+"""
+
+import zlib
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+
+from rebookmaker.stats import get_media_type
+
+ZLIB_ENCODER = 'zlib'
+ZOPFLI_ENCODER = 'zopfli'
+
+
+class CompressionProfile:
+
+    """A deflate level (or None for storing) for every media type.
+
+    levels maps media types such as "image/png", or wildcards such as
+    "image/*", to levels, and default_level is used for the rest.
+    text_encoder is the encoder of the non-image members.
+    """
+
+    def __init__(self, name, default_level, levels=None,
+                 text_encoder=ZLIB_ENCODER):
+        if text_encoder not in (ZLIB_ENCODER, ZOPFLI_ENCODER):
+            raise ValueError("Unknown encoder '{}'".format(text_encoder))
+        self.name = name
+        self.default_level = default_level
+        self.levels = dict(levels or {})
+        self.text_encoder = text_encoder
+
+    def with_levels(self, levels):
+        """Return a copy of the profile with some levels overridden."""
+        return CompressionProfile(
+            self.name, self.default_level, dict(self.levels, **levels),
+            self.text_encoder)
+
+    def get_level(self, media_type):
+        """Return the deflate level of media_type or None for storing."""
+        if media_type in self.levels:
+            return self.levels[media_type]
+        wildcard = media_type.split('/')[0] + '/*'
+        if wildcard in self.levels:
+            return self.levels[wildcard]
+        return self.default_level
+
+    def get_method(self, arcname):
+        """Return the (compress_type, level, encoder) of arcname.
+
+        The method also serves as a cache key of the compressed stream.
+        """
+        media_type = get_media_type(arcname)
+        level = self.get_level(media_type)
+        if arcname == 'mimetype' or level is None:
+            return (ZIP_STORED, None, None)
+        encoder = (ZLIB_ENCODER if media_type.startswith('image/')
+                   else self.text_encoder)
+        return (ZIP_DEFLATED, level, encoder)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'default_level': self.default_level,
+            'levels': dict(self.levels),
+            'text_encoder': self.text_encoder,
+        }
+
+
+PROFILES = {
+    'fast': CompressionProfile('fast', 1, {'image/*': None}),
+    'balanced': CompressionProfile('balanced', 6, {'image/*': 1}),
+    'smallest': CompressionProfile('smallest', 9),
+    'maximum': CompressionProfile(
+        'maximum', 9, text_encoder=ZOPFLI_ENCODER),
+}
+
+
+def get_profile(name):
+    """Return the CompressionProfile called name."""
+    try:
+        profile = PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown compression profile '{}'".format(name))
+    if profile.text_encoder == ZOPFLI_ENCODER:
+        try:
+            import zopfli.zlib  # noqa: F401
+        except ImportError:
+            raise ValueError(
+                "The '{}' compression profile requires the zopfli module"
+                .format(name))
+    return profile
+
+
+def parse_levels(specs):
+    """Parse "MEDIA_TYPE=LEVEL" strings (LEVEL may be "store")."""
+    levels = {}
+    for spec in specs:
+        media_type, sep, level = spec.partition('=')
+        if not sep:
+            raise ValueError("Malformed level '{}'".format(spec))
+        if level == 'store':
+            levels[media_type] = None
+        else:
+            levels[media_type] = int(level)
+            if not (0 <= levels[media_type] <= 9):
+                raise ValueError("Level out of range in '{}'".format(spec))
+    return levels
+
+
+def deflate(data, level, encoder=ZLIB_ENCODER):
+    """Return the raw deflate stream of data."""
+    if encoder == ZOPFLI_ENCODER:
+        import zopfli.zlib
+
+        # Strip the 2 bytes zlib header and the Adler-32 trailer.
+        return zopfli.zlib.compress(bytes(data))[2:-4]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.dedup - store identical images under different paths once.
+
+With EbookMaker(dedup_images=True) (or "--dedup-images") every image is
+hashed when it is first referenced, and the first path of its contents
+(the cover comes first) is its canonical one.  The <img src="..."> of the
+other paths are rewritten in the chapters before they are written, so
+every distinct image has a single member and manifest item.
+"""
+
+import hashlib
+import html
+import re
+
+_IMG_SRC_RE = re.compile(
+    "(<(?:[^\\s/>!?:]+:)?img\\b"
+    "(?:[^>\"']|\"[^\"]*\"|'[^']*')*?\\ssrc\\s*=\\s*)"
+    "(?:\"([^\"]*)\"|'([^']*)')",
+    re.S
+)
+_HASH_CHUNK_SIZE = (1 << 16)
+
+
+class ImageDeduplicator:
+
+    """Map the image paths read from provider to their canonical paths."""
+
+    def __init__(self, provider):
+        self._provider = provider
+        self._digests = {}
+        # path -> canonical path
+        self._canonical = {}
+        # The number of paths which were found to be duplicates.
+        self.duplicates = 0
+
+    def _digest(self, src):
+        digest = hashlib.sha256()
+        with self._provider.open(src) as file_handle:
+            while True:
+                chunk = file_handle.read(_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.digest()
+
+    def get_canonical(self, src):
+        """Return the canonical path of the image src.
+
+        A missing image is its own canonical path, so it is reported by
+        the validation or when it is written.
+        """
+        try:
+            return self._canonical[src]
+        except KeyError:
+            pass
+        if not self._provider.exists(src):
+            canonical = src
+        else:
+            canonical = self._digests.setdefault(self._digest(src), src)
+            if canonical != src:
+                self.duplicates += 1
+        self._canonical[src] = canonical
+        return canonical
+
+    def get_aliases(self, srcs):
+        """Return a dict of the srcs which are not canonical to their
+
+        canonical paths.
+        """
+        ret = {}
+        for src in srcs:
+            canonical = self.get_canonical(src)
+            if canonical != src:
+                ret[src] = canonical
+        return ret
+
+
+def rewrite_image_srcs(text, aliases):
+    """Replace the <img src="..."> values in text using aliases."""
+    def _replace(match):
+        value = (match.group(2) if match.group(2) is not None
+                 else match.group(3))
+        src = html.unescape(value)
+        if src not in aliases:
+            return match.group(0)
+        return match.group(1) + '"' + html.escape(aliases[src]) + '"'
+    return _IMG_SRC_RE.sub(_replace, text)
@@ -0,0 +1,37 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.depfile - write the inputs of a build as a Makefile fragment.
+
+The format is the one of "gcc -MD -MP", which both GNU make
+("-include book.epub.d") and Ninja ("depfile = $out.d") read.  Every
+input also gets an empty rule, so deleting one of them does not break
+the build.
+"""
+
+
+def _escape(path):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+def format_depfile(target, dependencies):
+    """Return the depfile text of target and its list of dependencies."""
+    lines = [_escape(target) + ':']
+    for path in dependencies:
+        lines[-1] += ' \\'
+        lines.append(' ' + _escape(path))
+    text = "\n".join(lines) + "\n"
+    for path in dependencies:
+        text += "\n" + _escape(path) + ":\n"
+    return text
+
+
+def write_depfile(depfile_fn, target, dependencies):
+    """Write the depfile of target and its dependencies into depfile_fn."""
+    with open(depfile_fn, 'wt') as file_handle:
+        file_handle.write(format_depfile(target, dependencies))
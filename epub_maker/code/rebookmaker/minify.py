@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.minify - strip insignificant whitespace and comments.
+
+EbookMaker(minify=True) (or "--minify") passes the chapters through
+minify_xhtml() and the style sheet through minify_css() on their way to
+the archive.  Both are conservative: the contents of <pre>, <textarea>,
+<script> and <style> and of CDATA sections are kept as they are, and a
+run of whitespace in the text is collapsed to a single space (or a
+newline) rather than removed, unless it only separates block level
+tags.
+"""
+
+import re
+
+_XHTML_TOKEN_RE = re.compile(
+    "(<!--.*?-->)|<!\\[CDATA\\[.*?\\]\\]>|<\\?.*?\\?>|<![^>]*>|"
+    "</([^\\s>]+)\\s*>|"
+    "<([^\\s/>!?]+)(?:[^>\"']|\"[^\"]*\"|'[^']*')*?(/?)>",
+    re.S
+)
+_WHITESPACE_RE = re.compile("[ \\t\\r\\n]+")
+
+# The elements whose contents are kept as they are.
+_PRESERVE = frozenset(['pre', 'textarea', 'script', 'style'])
+
+# The elements around which whitespace is insignificant.
+_BLOCKS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'body', 'caption', 'col',
+    'colgroup', 'dd', 'div', 'dl', 'dt', 'figcaption', 'figure', 'footer',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html',
+    'li', 'link', 'main', 'meta', 'nav', 'ol', 'p', 'section', 'table',
+    'tbody', 'td', 'tfoot', 'th', 'thead', 'title', 'tr', 'ul',
+])
+
+
+def _local_name(name):
+    return name.rsplit(':', 1)[-1].lower()
+
+
+def _collapse(match):
+    return "\n" if "\n" in match.group(0) else " "
+
+
+def minify_xhtml(text):
+    """Return the XHTML text without comments and extra whitespace."""
+    out = []
+    preserve_depth = 0
+    pos = 0
+    # Whether the previous token was a block level tag.
+    prev_block = True
+    pending = None
+    for match in _XHTML_TOKEN_RE.finditer(text):
+        chunk = text[pos:match.start()]
+        pos = match.end()
+        is_comment = match.group(1) is not None
+        name = match.group(2) or match.group(3)
+        is_block = (name is not None and _local_name(name) in _BLOCKS)
+        if preserve_depth:
+            out.append(chunk)
+        elif chunk:
+            if chunk.strip():
+                if pending is not None:
+                    out.append(pending)
+                    pending = None
+                chunk = _WHITESPACE_RE.sub(_collapse, chunk)
+                # E.g. "text <!-- comment --> text".
+                if out and out[-1][-1:] in (" ", "\n") and \
+                        chunk[:1] in (" ", "\n"):
+                    chunk = chunk[1:]
+                out.append(chunk)
+                prev_block = False
+            elif not prev_block:
+                pending = _WHITESPACE_RE.sub(_collapse, chunk)
+        if is_comment and not preserve_depth:
+            continue
+        if pending is not None:
+            if not is_block:
+                out.append(pending)
+            pending = None
+        out.append(match.group(0))
+        if name is None:
+            prev_block = False
+            continue
+        prev_block = is_block
+        if _local_name(name) in _PRESERVE and not match.group(4):
+            preserve_depth += (-1 if match.group(2) else 1)
+            preserve_depth = max(preserve_depth, 0)
+    tail = text[pos:]
+    if preserve_depth:
+        out.append(tail)
+    elif tail.strip():
+        out.append(_WHITESPACE_RE.sub(_collapse, tail))
+    elif tail:
+        out.append("\n")
+    return ''.join(out)
+
+
+_CSS_TOKEN_RE = re.compile(
+    "(/\\*.*?\\*/)|(\"(?:[^\"\\\\]|\\\\.)*\"|'(?:[^'\\\\]|\\\\.)*')|"
+    "([^\"'/]+|/)",
+    re.S
+)
+_CSS_SPACE_RE = re.compile("\\s*([{};,>])\\s*")
+
+
+def minify_css(text):
+    """Return the CSS text without comments and extra whitespace."""
+    out = []
+    for match in _CSS_TOKEN_RE.finditer(text):
+        if match.group(1) is not None:
+            continue
+        if match.group(2) is not None:
+            out.append(match.group(2))
+            continue
+        code = _WHITESPACE_RE.sub(" ", match.group(3))
+        out.append(_CSS_SPACE_RE.sub("\\1", code).replace(";}", "}"))
+    ret = ''.join(out).strip()
+    return ret + "\n" if ret else ret
@@ -0,0 +1,360 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.providers - where the chapters, images and style sheet of a
+book are read from.
+
+An input provider maps the relative names which appear in the book
+definition (the "source"-s of "contents", the <img src="..."> values,
+"cover" and "style.css") to their contents.  There are three backends:
+
+* DirectoryProvider - files under a directory (by default the current
+one, which is how rebookmaker always worked).
+
+* MemoryProvider - a mapping of names to bytes or strings.
+
+* ArchiveProvider - the members of a zip or tar archive.
+"""
+
+import fnmatch
+import io
+import os
+import posixpath
+import threading
+
+
+def _glob_match(pattern, name):
+    """Whether name matches the glob pattern like glob.glob() would.
+
+    "*" and "?" do not match "/" and names starting with "." are only
+    matched by patterns starting with "." .
+    """
+    pattern_parts = pattern.split('/')
+    name_parts = name.split('/')
+    if len(pattern_parts) != len(name_parts):
+        return False
+    for pattern_part, name_part in zip(pattern_parts, name_parts):
+        if name_part.startswith('.') and not pattern_part.startswith('.'):
+            return False
+        if not fnmatch.fnmatchcase(name_part, pattern_part):
+            return False
+    return True
+
+
+def _normalize_name(name):
+    """Normalize the archive member name (or the name of a file in it).
+
+    "./a/../b.xhtml" becomes "b.xhtml", and "." becomes "".
+    """
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    return ('' if name == '.' else name)
+
+
+class InputProvider:
+
+    """The interface of the input providers."""
+
+    def read_bytes(self, name):
+        """Return the contents of name as bytes.
+
+        Raises a FileNotFoundError if there is no such file.
+        """
+        raise NotImplementedError
+
+    def open(self, name):
+        """Return a binary file object for reading name."""
+        return io.BytesIO(self.read_bytes(name))
+
+    def size(self, name):
+        """Return the size of name in bytes."""
+        return len(self.read_bytes(name))
+
+    def exists(self, name):
+        """Whether the file name exists."""
+        raise NotImplementedError
+
+    def glob(self, pattern):
+        """Return the names which match the glob pattern, sorted."""
+        raise NotImplementedError
+
+    def dependency_path(self, name):
+        """Return the filesystem path which name is read from, or None."""
+        return None
+
+    def close(self):
+        """Release the resources of the provider."""
+
+
+class DirectoryProvider(InputProvider):
+
+    """Read the files under the directory root.
+
+    If root is None, names are used as they are, so they are relative to
+    the current directory of the process.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def _path(self, name):
+        if self.root is None:
+            return name
+        return os.path.join(self.root, name)
+
+    def read_bytes(self, name):
+        with open(self._path(name), 'rb') as file_handle:
+            return file_handle.read()
+
+    def open(self, name):
+        return open(self._path(name), 'rb')
+
+    def size(self, name):
+        return os.path.getsize(self._path(name))
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def dependency_path(self, name):
+        return self._path(name)
+
+    def glob(self, pattern):
+        from glob import escape, glob
+
+        if self.root is None or os.path.isabs(pattern):
+            return sorted(glob(pattern))
+        prefix_len = len(os.path.join(self.root, ''))
+        return sorted(
+            fn[prefix_len:]
+            for fn in glob(os.path.join(escape(self.root), pattern))
+        )
+
+
+class MemoryProvider(InputProvider):
+
+    """Read the files from the files mapping of names to bytes or str-s.
+
+    str values are encoded as UTF-8.
+    """
+
+    def __init__(self, files):
+        self.files = files
+
+    def read_bytes(self, name):
+        try:
+            data = self.files[name]
+        except KeyError:
+            raise FileNotFoundError(
+                "No such file in the memory provider: '{}'".format(name))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return data
+
+    def exists(self, name):
+        return name in self.files
+
+    def glob(self, pattern):
+        return sorted(
+            name for name in self.files if _glob_match(pattern, name))
+
+
+class ArchiveProvider(InputProvider):
+
+    """Read the members of the zip or tar archive at path.
+
+    prefix is an optional directory inside the archive, which names
+    are relative to.  The member names are normalized, so the ones of
+    archives created by "tar -cf book.tar ." (such as "./book.json")
+    are found too.  The archive is opened on first use (and again in
+    every process it is pickled to).
+    """
+
+    def __init__(self, path, prefix=''):
+        self.path = path
+        prefix = _normalize_name(prefix)
+        self.prefix = (prefix + '/' if prefix else '')
+        self._archive = None
+        self._names = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'path': self.path, 'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+        self.prefix = state['prefix']
+
+    def _open(self):
+        """Open the archive and list its files (under self._lock)."""
+        if self._archive is not None:
+            return
+        import zipfile
+
+        if zipfile.is_zipfile(self.path):
+            self._archive = zipfile.ZipFile(self.path, 'r')
+            names = [
+                info.filename for info in self._archive.infolist()
+                if not info.is_dir()
+            ]
+        else:
+            import tarfile
+
+            self._archive = tarfile.open(self.path, 'r:*')
+            names = [
+                info.name for info in self._archive.getmembers()
+                if info.isfile()
+            ]
+        prefix_len = len(self.prefix)
+        self._names = {}
+        for name in names:
+            normalized = _normalize_name(name)
+            if normalized.startswith(self.prefix):
+                self._names[normalized[prefix_len:]] = name
+
+    def _member(self, name):
+        """Return the member name of name (under self._lock)."""
+        self._open()
+        try:
+            return self._names[_normalize_name(name)]
+        except KeyError:
+            raise FileNotFoundError(
+                "No such file in '{}': '{}'".format(self.path, name))
+
+    def read_bytes(self, name):
+        with self._lock:
+            member = self._member(name)
+            if hasattr(self._archive, 'extractfile'):
+                with self._archive.extractfile(member) as file_handle:
+                    return file_handle.read()
+            return self._archive.read(member)
+
+    def open(self, name):
+        with self._lock:
+            member = self._member(name)
+            if hasattr(self._archive, 'extractfile'):
+                # The stream of a tar member reads the file object of the
+                # archive, which other threads seek, so read it whole here.
+                with self._archive.extractfile(member) as file_handle:
+                    return io.BytesIO(file_handle.read())
+            return self._archive.open(member)
+
+    def size(self, name):
+        with self._lock:
+            member = self._member(name)
+            if hasattr(self._archive, 'getmember'):
+                return self._archive.getmember(member).size
+            return self._archive.getinfo(member).file_size
+
+    def exists(self, name):
+        with self._lock:
+            self._open()
+            return _normalize_name(name) in self._names
+
+    def glob(self, pattern):
+        with self._lock:
+            self._open()
+            return sorted(
+                name for name in self._names if _glob_match(pattern, name))
+
+    def dependency_path(self, name):
+        return self.path
+
+    def close(self):
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+                self._names = None
+
+
+class RecordingProvider(InputProvider):
+
+    """Wrap provider and record the names of the files read from it.
+
+    If digest is true, the SHA-256 digests of their contents are
+    recorded in self.digests as well.
+    """
+
+    def __init__(self, provider, digest=False):
+        self.provider = provider
+        self.read_names = []
+        self._seen = set()
+        self.digests = ({} if digest else None)
+
+    def read_bytes(self, name):
+        data = self.provider.read_bytes(name)
+        if name not in self._seen:
+            self._seen.add(name)
+            self.read_names.append(name)
+            if self.digests is not None:
+                import hashlib
+
+                self.digests[name] = hashlib.sha256(data).digest()
+        return data
+
+    def open(self, name):
+        file_handle = self.provider.open(name)
+        if name in self._seen:
+            return file_handle
+        self._seen.add(name)
+        self.read_names.append(name)
+        if self.digests is None:
+            return file_handle
+        return io.BufferedReader(
+            _DigestReader(file_handle, self.digests, name))
+
+    def size(self, name):
+        return self.provider.size(name)
+
+    def exists(self, name):
+        return self.provider.exists(name)
+
+    def glob(self, pattern):
+        return self.provider.glob(pattern)
+
+    def dependency_path(self, name):
+        return self.provider.dependency_path(name)
+
+    def dependencies(self):
+        """Return the distinct dependency paths of the files read so far."""
+        ret = []
+        seen = set()
+        for name in self.read_names:
+            path = self.dependency_path(name)
+            if path is not None and path not in seen:
+                seen.add(path)
+                ret.append(path)
+        return ret
+
+
+class _DigestReader(io.RawIOBase):
+
+    """Read file_handle and put the digest of its contents in digests."""
+
+    def __init__(self, file_handle, digests, name):
+        import hashlib
+
+        self._file_handle = file_handle
+        self._digest = hashlib.sha256()
+        self._digests = digests
+        self._name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self._file_handle.read(len(buf))
+        buf[:len(data)] = data
+        self._digest.update(data)
+        if not data:
+            self._digests[self._name] = self._digest.digest()
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file_handle.close()
+        super(_DigestReader, self).close()
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.scanner - collect the <img src="..."> references and the
+headings of an (X)HTML source.
+
+The default scanner is driven by the events of an lxml feed parser and
+never builds a tree, so its memory use is bounded by the nesting depth of
+the document rather than by its size.  The BeautifulSoup based scanner is
+kept for comparison.
+"""
+
+SCAN_CHUNK_SIZE = (1 << 16)
+
+STREAM_SCANNER = 'stream'
+BS4_SCANNER = 'bs4'
+SCANNERS = (STREAM_SCANNER, BS4_SCANNER,)
+
+
+def _local_name(tag):
+    if tag[:1] == '{':
+        return tag[tag.index('}')+1:]
+    return tag
+
+
+class _ScanTarget:
+
+    """lxml parser target which records images and headings."""
+
+    def __init__(self, html_src, h_tags):
+        self._html_src = html_src
+        self._h_tags = frozenset(h_tags)
+        self._open_headings = []
+        self.images = []
+        self.page_nav = []
+
+    def start(self, tag, attrib):
+        name = _local_name(tag)
+        if name == 'img':
+            src = attrib.get('src')
+            if src:
+                self.images.append(src)
+        elif name in self._h_tags:
+            label = None
+            if 'id' in attrib:
+                label = []
+                self.page_nav.append((
+                    int(name[-1]),
+                    self._html_src + "#" + attrib['id'],
+                    label,
+                ))
+            self._open_headings.append((name, label))
+
+    def end(self, tag):
+        name = _local_name(tag)
+        if self._open_headings and self._open_headings[-1][0] == name:
+            self._open_headings.pop()
+
+    def data(self, data):
+        for _name, label in self._open_headings:
+            if label is not None:
+                label.append(data)
+
+    def close(self):
+        self._open_headings = []
+        return self.images, [
+            (level, href, ''.join(label))
+            for level, href, label in self.page_nav
+        ]
+
+
+class StreamScanner:
+
+    """Scan html_src as it is fed in chunks (of str or of bytes).
+
+    close() returns what stream_scan() does.
+    """
+
+    def __init__(self, html_src, h_tags):
+        from lxml import etree
+
+        self._parser = etree.XMLParser(
+            target=_ScanTarget(html_src=html_src, h_tags=h_tags),
+            recover=True,
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=True,
+        )
+
+    def feed(self, data):
+        if data:
+            self._parser.feed(data)
+
+    def close(self):
+        return self._parser.close()
+
+
+def stream_scan(text, html_src, h_tags):
+    """Scan text (a str or bytes) in one forward pass.
+
+    Returns a tuple of the list of the image sources in document order
+    and of the list of the (level, href, label) heading records of
+    html_src.
+    """
+    scanner = StreamScanner(html_src=html_src, h_tags=h_tags)
+    for start in range(0, len(text), SCAN_CHUNK_SIZE):
+        scanner.feed(text[start:start+SCAN_CHUNK_SIZE])
+    return scanner.close()
+
+
+def bs4_scan(text, html_src, h_tags):
+    """Scan text using a full BeautifulSoup tree (the original method)."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(text, features='lxml-xml', )
+    images = []
+    for img in soup.find_all('img'):
+        src = img.get('src')
+        if src:
+            images.append(src)
+    page_nav = []
+    for h_elem in soup.find_all(h_tags):
+        if not h_elem.has_attr('id'):
+            # Skip
+            continue
+        page_nav.append(
+            (
+                int(h_elem.name[-1]),
+                html_src+"#"+h_elem['id'],
+                h_elem.get_text(),
+            )
+        )
+    return images, page_nav
+
+
+def get_scan_function(scanner):
+    """Return the scanning function for the scanner name."""
+    if scanner == STREAM_SCANNER:
+        return stream_scan
+    if scanner == BS4_SCANNER:
+        return bs4_scan
+    raise ValueError("Unknown scanner '{}'".format(scanner))
@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.server - a long-lived build server on a Unix domain socket.
+
+The protocol is line-delimited JSON.  Every request is a single line
+such as:
+
+    {"json": "/abs/book.json", "output": "/abs/book.epub",
+     "directory": "/abs/build-dir", "incremental": false}
+
+"directory" is where the sources of the book are looked up, and relative
+"json" and "output" paths are relative to it.  "incremental" defaults to
+the server's setting.  The server replies with a single line of either
+{"ok": true} or {"ok": false, "error": "..."}.  {"command": "ping"} is
+answered with {"ok": true} as well.  A client may send several requests
+over the same connection.
+"""
+
+import json
+import os
+import socket
+import stat
+
+
+def _job_from_request(request):
+    from rebookmaker.batch import BatchJob
+
+    directory = request.get('directory') or os.getcwd()
+
+    def _path(path):
+        if path is None:
+            return None
+        return os.path.join(directory, path)
+    return BatchJob(
+        json_fn=_path(request['json']),
+        output_filename=_path(request.get('output')),
+        directory=directory,
+    )
+
+
+def _remove_stale_socket(socket_path):
+    """Remove the socket of a server which is no longer running.
+
+    Raises a FileExistsError if socket_path is anything else, including
+    the socket of a running server.
+    """
+    try:
+        st = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(
+            "'{}' exists and is not a socket".format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise FileExistsError(
+        "A server is already running on '{}'".format(socket_path))
+
+
+class BuildServer:
+
+    """Serve build requests using a single warm EbookMaker.
+
+    At most workers books are built at once, by a thread pool.
+    """
+
+    def __init__(self, socket_path, workers=1, incremental=False,
+                 **maker_kwargs):
+        self.socket_path = socket_path
+        self._workers = workers
+        self._incremental = incremental
+        self._maker_kwargs = maker_kwargs
+        self._server = None
+        self._executor = None
+        self._maker = None
+
+    def _start_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from rebookmaker.batch import make_shared_maker
+
+        self._maker = make_shared_maker(**self._maker_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max(self._workers, 1))
+
+    def handle_request(self, request):
+        """Handle the decoded request and return the reply."""
+        from rebookmaker import batch
+
+        if request.get('command', 'build') == 'ping':
+            return {'ok': True}
+        if request.get('command', 'build') != 'build':
+            return {'ok': False, 'error': "Unknown command '{}'".format(
+                request['command'])}
+        try:
+            job = _job_from_request(request)
+        except (KeyError, TypeError) as e:
+            return {'ok': False, 'error': "Malformed request: {}".format(e)}
+        error = self._executor.submit(
+            batch._build_job, self._maker, job,
+            bool(request.get('incremental', self._incremental))).result()
+        if error is not None:
+            return {'ok': False, 'error': error}
+        return {'ok': True}
+
+    def _make_server(self):
+        import socketserver
+
+        build_server = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                        if not isinstance(request, dict):
+                            raise ValueError("not a JSON object")
+                    except ValueError as e:
+                        reply = {'ok': False,
+                                 'error': "Malformed request: {}".format(e)}
+                    else:
+                        reply = build_server.handle_request(request)
+                    self.wfile.write(
+                        json.dumps(reply).encode('utf-8') + b"\n")
+                    self.wfile.flush()
+
+        class _Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        _remove_stale_socket(self.socket_path)
+        return _Server(self.socket_path, _Handler)
+
+    def serve_forever(self):
+        """Accept requests until shutdown() is called.
+
+        Raises a FileExistsError if socket_path exists and is not the
+        stale socket of a server which is no longer running.
+        """
+        self._server = self._make_server()
+        try:
+            self._start_executor()
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if self._executor is not None:
+                self._executor.shutdown()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop serve_forever() (from a different thread)."""
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def request_build(socket_path, json_fn, output_filename, directory=None,
+                  incremental=None):
+    """Ask the server at socket_path to build a book and wait for it.
+
+    Raises a RuntimeError if the build failed.
+    """
+    request = {
+        'json': json_fn,
+        'output': output_filename,
+        'directory': (os.getcwd() if directory is None else directory),
+    }
+    if incremental is not None:
+        request['incremental'] = incremental
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+        with sock.makefile('rb') as file_handle:
+            line = file_handle.readline()
+    if not line:
+        raise RuntimeError("The rebookmaker server closed the connection")
+    reply = json.loads(line)
+    if not reply.get('ok'):
+        raise RuntimeError(reply.get('error', 'unknown error'))
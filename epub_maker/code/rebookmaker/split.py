@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.split - split oversized XHTML chapters at their headings.
+
+E-readers load and paginate a whole spine item at a time, so a chapter
+larger than the "max_chapter_bytes" of its "contents" item (or of the
+"toc") is split into several documents before its <h1>..<h6> headings.
+Every part gets the prolog and the <head> of the original, and the
+elements which were open at the split point are closed at the end of a
+part and opened again at the start of the next one.
+
+The markup is tokenized by regular expressions in a single pass, without
+building a tree, so the sources are expected to be well-formed XHTML.
+Links to the headings from other documents are not rewritten, except for
+the ones in the generated navigation.
+"""
+
+from bisect import bisect_right
+import html
+import os
+import re
+
+_TOKEN_RE = re.compile(
+    "<!--.*?-->|<!\\[CDATA\\[.*?\\]\\]>|<\\?.*?\\?>|<![^>]*>|"
+    "</([^\\s>]+)\\s*>|"
+    "<([^\\s/>!?]+)((?:[^>\"']|\"[^\"]*\"|'[^']*')*?)(/?)>",
+    re.S
+)
+_ID_RE = re.compile("\\sid\\s*=\\s*(?:\"([^\"]*)\"|'([^']*)')")
+_HEADING_RE = re.compile("\\Ah[1-6]\\Z")
+
+
+def _local_name(name):
+    return name.rsplit(':', 1)[-1].lower()
+
+
+def get_part_name(html_src, idx):
+    """Return the name of the part idx (0 is the first) of html_src."""
+    if idx == 0:
+        return html_src
+    base, ext = os.path.splitext(html_src)
+    return "{}-part{}{}".format(base, idx + 1, ext)
+
+
+def _find_split_points(text):
+    """Scan text for the positions where it may be split.
+
+    Returns the offset of the end of the <body> start tag, the offset of
+    the </body> end tag, the list of (offset, open start tags) split
+    points and the list of (offset, id) of the headings.
+    """
+    body_start = body_end = None
+    # [name, start tag, offset, whether it has content yet]
+    stack = []
+    points = []
+    heading_ids = []
+    last_end = 0
+    # Whether the body has any content yet, so the first part will not
+    # be empty.
+    has_content = False
+    for match in _TOKEN_RE.finditer(text):
+        if body_start is not None and \
+                text[last_end:match.start()].strip():
+            has_content = True
+            if stack:
+                stack[-1][3] = True
+        last_end = match.end()
+        end_name, start_name = match.group(1), match.group(2)
+        if end_name is not None:
+            name = _local_name(end_name)
+            if name == 'body':
+                body_end = match.start()
+                break
+            if body_start is not None and \
+                    any(rec[0] == name for rec in stack):
+                while stack.pop()[0] != name:
+                    pass
+                has_content = True
+                if stack:
+                    stack[-1][3] = True
+            continue
+        if start_name is None:
+            continue
+        name = _local_name(start_name)
+        if body_start is None:
+            if name == 'body':
+                body_start = match.end()
+            continue
+        if _HEADING_RE.match(name) and has_content:
+            # Split before the enclosing elements which start with the
+            # heading, such as <section><header><h2>.
+            depth = len(stack)
+            while depth and not stack[depth-1][3]:
+                depth -= 1
+            offset = (stack[depth][2] if depth < len(stack)
+                      else match.start())
+            points.append((offset, tuple(rec[1] for rec in stack[:depth])))
+        if _HEADING_RE.match(name):
+            id_match = _ID_RE.search(match.group(3))
+            if id_match:
+                heading_ids.append((match.start(), html.unescape(
+                    id_match.group(1) if id_match.group(1) is not None
+                    else id_match.group(2))))
+        if match.group(4):
+            has_content = True
+            if stack:
+                stack[-1][3] = True
+        else:
+            stack.append([name, match.group(0), match.start(), False])
+    return body_start, body_end, points, heading_ids
+
+
+def _choose_split_points(text, points, max_bytes):
+    """Choose the split points which keep the parts within max_bytes
+
+    where possible.
+    """
+    chosen = []
+    start = 0
+    prev = None
+    prev_offset = 0
+    prev_bytes = 0
+    for point in points + [(len(text), None)]:
+        offset = point[0]
+        point_bytes = prev_bytes + len(
+            text[prev_offset:offset].encode('utf-8'))
+        prev_offset, prev_bytes = offset, point_bytes
+        if prev is not None and point_bytes - start > max_bytes:
+            chosen.append(prev[0])
+            start = prev[1]
+            prev = None
+        if point[1] is not None and point_bytes > start:
+            prev = (point, point_bytes)
+    return chosen
+
+
+def split_chapter(text, html_src, max_bytes):
+    """Split the XHTML text of html_src into parts of up to max_bytes.
+
+    Parts may still be larger if they contain no headings to split at.
+    Returns the list of the (name, text) of the parts (a single one if
+    text is not split) and a function which maps the href of a heading
+    in html_src to the one in its part.
+    """
+    def _same_href(href):
+        return href
+    if len(text) * 4 <= max_bytes or \
+            len(text.encode('utf-8')) <= max_bytes:
+        return [(html_src, text)], _same_href
+    body_start, body_end, points, heading_ids = _find_split_points(text)
+    if body_start is None or body_end is None:
+        return [(html_src, text)], _same_href
+    chosen = _choose_split_points(text, points, max_bytes)
+    if not chosen:
+        return [(html_src, text)], _same_href
+    head = text[:body_start]
+    tail = text[body_end:]
+    parts = []
+    offset = 0
+    open_tags = ()
+    for split_offset, split_open_tags in chosen + [(len(text), None)]:
+        part = [] if offset == 0 else [head, "\n"] + list(open_tags)
+        part.append(text[offset:split_offset])
+        if split_open_tags is not None:
+            part.extend(
+                "</" + _TOKEN_RE.match(tag).group(2) + ">"
+                for tag in reversed(split_open_tags))
+            part += ["\n", tail]
+        parts.append((get_part_name(html_src, len(parts)), ''.join(part)))
+        offset, open_tags = split_offset, (split_open_tags or ())
+    offsets = [split_offset for split_offset, _tags in chosen]
+    id_parts = dict(
+        (id_, bisect_right(offsets, heading_offset))
+        for heading_offset, id_ in heading_ids
+    )
+    prefix = html_src + '#'
+
+    def _get_href(href):
+        if not href.startswith(prefix):
+            return href
+        id_ = href[len(prefix):]
+        return get_part_name(html_src, id_parts.get(id_, 0)) + '#' + id_
+    return parts, _get_href
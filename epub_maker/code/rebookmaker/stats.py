@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.stats - the timings and the counters of a build.
+
+EbookMaker.make_epub_from_data() returns a BuildStats, and passes it to
+the stats_hook of the EbookMaker if there is one.
+"""
+
+from contextlib import contextmanager
+import os
+import time
+
+# The phases of a build, in their order.
+PHASES = ('scan', 'chapters', 'images', 'render', 'finalize',)
+
+_MEDIA_TYPES = {
+    '.css': 'text/css',
+    '.html': 'application/xhtml+xml',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.ncx': 'application/x-dtbncx+xml',
+    '.opf': 'application/oebps-package+xml',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.xhtml': 'application/xhtml+xml',
+    '.xml': 'application/xml',
+}
+
+
+def get_media_type(arcname):
+    """Return the media type of the archive member arcname."""
+    if arcname == 'mimetype':
+        return 'text/plain'
+    return _MEDIA_TYPES.get(
+        os.path.splitext(arcname)[1].lower(), 'application/octet-stream')
+
+
+class BuildStats:
+
+    """The statistics of building a single book.
+
+    phases maps every one of PHASES to its wall time in seconds:
+
+    * scan - scanning the chapters for images and headings.  With
+    workers > 1 these are the times spent in the worker processes.
+    * chapters - reading, stripping and writing the chapters.
+    * images - reading and writing the images and the style sheet.
+    * render - rendering the cover, the OPF, the NCX and the navigation.
+    * finalize - writing the remaining members and closing the archive.
+    """
+
+    def __init__(self):
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.headings = 0
+        self.images = 0
+        # The paths of the files which were read, for depfiles.
+        self.inputs = []
+        # Whether an identical existing output was kept (only_if_changed).
+        self.output_unchanged = False
+        # Whether the EPUB was copied from the output cache.
+        self.output_cache_hit = False
+        # The name of the compression profile, if one was used.
+        self.compression_profile = None
+        # The number of members the profile stored as they did not shrink.
+        self.stored_uncompressible = 0
+        # media type -> [uncompressed size, compressed size]
+        self.media_types = {}
+        # The sizes of the minified members before and after minifying.
+        self.minified_before = 0
+        self.minified_after = 0
+        # The number of image paths which duplicated other images.
+        self.duplicate_images = 0
+        self._source_times = []
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def add_source(self, html_src, seconds, scan_time):
+        """Record the time spent on the chapter html_src."""
+        self.phases['scan'] += scan_time
+        self.phases['chapters'] += max(seconds - scan_time, 0.0)
+        self._source_times.append((max(seconds, scan_time), html_src))
+
+    def add_minified(self, before, after):
+        """Record the sizes of a member before and after minifying it."""
+        self.minified_before += before
+        self.minified_after += after
+
+    def add_members(self, infos):
+        """Record the sizes of the ZipInfo-s of the written archive."""
+        for info in infos:
+            sizes = self.media_types.setdefault(
+                get_media_type(info.filename), [0, 0])
+            sizes[0] += info.file_size
+            sizes[1] += info.compress_size
+
+    def slowest_sources(self, num=5):
+        """Return the (seconds, html_src) of the num slowest chapters."""
+        return sorted(self._source_times, key=lambda rec: -rec[0])[:num]
+
+    def compression_ratios(self):
+        """Return a dict of media type to compressed / uncompressed."""
+        return dict(
+            (media_type, (compressed / size if size else 1.0))
+            for media_type, (size, compressed) in self.media_types.items()
+        )
+
+    def as_dict(self, slowest=5):
+        """Return the statistics as JSON-serializable data."""
+        return {
+            'phases': dict(self.phases),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'headings': self.headings,
+            'images': self.images,
+            'inputs': list(self.inputs),
+            'output_unchanged': self.output_unchanged,
+            'output_cache_hit': self.output_cache_hit,
+            'compression_profile': self.compression_profile,
+            'stored_uncompressible': self.stored_uncompressible,
+            'minified_before': self.minified_before,
+            'minified_after': self.minified_after,
+            'duplicate_images': self.duplicate_images,
+            'media_types': dict(
+                (media_type, {
+                    'size': size, 'compressed_size': compressed,
+                    'ratio': self.compression_ratios()[media_type]})
+                for media_type, (size, compressed)
+                in self.media_types.items()
+            ),
+            'slowest_sources': [
+                [html_src, seconds]
+                for seconds, html_src in self.slowest_sources(slowest)
+            ],
+        }
+
+    def summary(self, slowest=5):
+        """Return a human readable summary of the statistics."""
+        lines = ["phases:"]
+        for phase in PHASES:
+            lines.append("    {:<10} {:9.4f}s".format(
+                phase, self.phases[phase]))
+        lines.append("bytes read: {}, bytes written: {}".format(
+            self.bytes_read, self.bytes_written))
+        lines.append("headings: {}, images: {}, duplicate images: {}".format(
+            self.headings, self.images, self.duplicate_images))
+        if self.compression_profile is not None:
+            lines.append(
+                "compression profile: {} ({} members stored as they did "
+                "not shrink)".format(
+                    self.compression_profile, self.stored_uncompressible))
+        if self.minified_before:
+            lines.append("minified: {} -> {} bytes (saved {})".format(
+                self.minified_before, self.minified_after,
+                self.minified_before - self.minified_after))
+        lines.append("compression ratios:")
+        ratios = self.compression_ratios()
+        for media_type in sorted(self.media_types):
+            size, compressed = self.media_types[media_type]
+            lines.append("    {:<32} {:>10} -> {:>10} ({:.3f})".format(
+                media_type, size, compressed, ratios[media_type]))
+        lines.append("slowest sources:")
+        for seconds, html_src in self.slowest_sources(slowest):
+            lines.append("    {:9.4f}s {}".format(seconds, html_src))
+        return "\n".join(lines)
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.validate - structural checks of a book, during its build.
+
+EbookMaker(validate=True) (or "rebookmaker build --check") checks the
+manifest, the guide and the headings which the build collected, without
+reparsing anything, and raises a ValidationError listing all the
+problems instead of writing the EPUB.  The chapters are kept in memory
+until the checks pass, so no member is written for an invalid book.
+It catches the usual mistakes which epubcheck reports, but it is not a
+replacement for its full conformance checks.
+"""
+
+from collections import Counter
+
+
+class ValidationError(Exception):
+
+    """The structural problems of a book, as a list of messages."""
+
+    def __init__(self, problems):
+        super(ValidationError, self).__init__(
+            "The book failed validation:\n" + "\n".join(
+                "    " + problem for problem in problems))
+        self.problems = problems
+
+
+def _duplicates(values):
+    return sorted(
+        value for value, count in Counter(values).items() if count > 1)
+
+
+def validate_book(manifest, guide, nav_points, exists):
+    """Return the list of the structural problems of a book.
+
+    manifest is the list of the dicts of the "href" and "media_type" of
+    its manifest items, guide is its list of guide references (or None),
+    and nav_points lists the (level, href, label) heading records of
+    every chapter.  exists(href) tells whether
+    the file of the image href can be read.
+    """
+    problems = []
+    for href in _duplicates(item['href'] for item in manifest):
+        problems.append("Duplicate manifest href '{}'".format(href))
+    hrefs = set(item['href'] for item in manifest)
+    for item in manifest:
+        if item['media_type'].startswith('image/') and \
+                not exists(item['href']):
+            problems.append("Missing image '{}'".format(item['href']))
+    for reference in (guide or []):
+        href = reference.get('href', '')
+        if href.split('#')[0] not in hrefs:
+            problems.append(
+                "The guide reference '{}' is not in the manifest"
+                .format(href))
+    xhtmls = set(
+        item['href'] for item in manifest
+        if item['media_type'] == 'application/xhtml+xml'
+    )
+    for file_nav_points in nav_points:
+        heading_hrefs = [href for _level, href, _label in file_nav_points]
+        for href in heading_hrefs:
+            fn, _sep, fragment = href.partition('#')
+            if fn not in xhtmls or not fragment:
+                problems.append(
+                    "The heading href '{}' does not exist".format(href))
+        for href in _duplicates(heading_hrefs):
+            problems.append(
+                "The heading href '{}' is ambiguous (duplicate id)"
+                .format(href))
+    return problems
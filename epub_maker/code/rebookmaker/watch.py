@@ -0,0 +1,272 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2020 Shlomi Fish <shlomif@cpan.org>
+#
+# Distributed under the MIT license.
+"""
+rebookmaker.watch - rebuild a book whenever its sources change.
+
+watch_book() builds the book, and then waits for changes of the files
+which the build read (the JSON, the chapters, the images and the style
+sheet) and of the files matching its globs, and rebuilds it
+incrementally.  The EbookMaker is kept, together with an in-memory
+ScanCache, so only the modified chapters are scanned again, and the
+members of the unchanged ones are copied from the previous EPUB.
+
+Changes are waited for using inotify if the inotify_simple module is
+available ("pip install inotify_simple"), and by polling otherwise.
+Changes which follow each other within the debounce interval cause a
+single rebuild.
+
+See "rebookmaker watch --help".
+"""
+
+import glob
+import json
+import os
+import time
+
+from rebookmaker.cache import MemoryScanCache
+
+DEFAULT_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class PollingWatcher:
+
+    """Wait for changes by comparing the stat()-s of the files."""
+
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+        self.interval = interval
+        self._paths = []
+        self._patterns = []
+        self._snapshot = None
+
+    def _take_snapshot(self):
+        snapshot = dict((path, _stat(path)) for path in self._paths)
+        for pattern in self._patterns:
+            for path in glob.glob(pattern):
+                snapshot[path] = _stat(path)
+        return snapshot
+
+    def watch(self, paths, patterns=()):
+        """Watch the files paths and the files matching the globs patterns.
+
+        The changes of the files which were already watched are relative
+        to their state when the last wait() returned, so the changes
+        made in between are not lost.
+        """
+        from fnmatch import fnmatchcase
+
+        previous = self._snapshot
+        old_patterns = self._patterns
+        self._paths = list(paths)
+        self._patterns = list(patterns)
+        self._snapshot = self._take_snapshot()
+        if previous is None:
+            return
+        for path in self._snapshot:
+            if path in previous:
+                self._snapshot[path] = previous[path]
+            elif any(fnmatchcase(path, pattern) for pattern in old_patterns):
+                # A new file which matches a glob.
+                self._snapshot[path] = None
+
+    def wait(self, timeout=None):
+        """Wait for changes for up to timeout seconds (None is forever).
+
+        Returns the sorted list of the changed paths, which is empty on
+        a timeout.
+        """
+        deadline = (None if timeout is None
+                    else time.monotonic() + timeout)
+        while True:
+            snapshot = self._take_snapshot()
+            changed = sorted(
+                path for path in set(snapshot) | set(self._snapshot)
+                if snapshot.get(path) != self._snapshot.get(path)
+            )
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+
+    """Wait for changes using inotify.
+
+    The directories of the files are watched, so files which are saved
+    by renaming a new file over them are followed.  Only the directory
+    parts of the patterns which have no wildcards are watched for new
+    files.
+    """
+
+    def __init__(self):
+        from inotify_simple import INotify
+        from inotify_simple import flags
+
+        self._inotify = INotify()
+        self._mask = (
+            flags.CLOSE_WRITE | flags.MODIFY | flags.CREATE | flags.DELETE |
+            flags.MOVED_TO | flags.MOVED_FROM | flags.ATTRIB
+        )
+        self._directories = {}
+        self._paths = set()
+        self._patterns = []
+
+    def watch(self, paths, patterns=()):
+        self._paths = set(os.path.abspath(path) for path in paths)
+        self._patterns = [os.path.abspath(pattern) for pattern in patterns]
+        directories = set(os.path.dirname(path) for path in self._paths)
+        for pattern in self._patterns:
+            dirname = os.path.dirname(pattern)
+            if not glob.has_magic(dirname):
+                directories.add(dirname)
+        for wd, dirname in list(self._directories.items()):
+            if dirname not in directories:
+                try:
+                    self._inotify.rm_watch(wd)
+                except OSError:
+                    pass
+                del self._directories[wd]
+        watched = set(self._directories.values())
+        for dirname in sorted(directories - watched):
+            try:
+                wd = self._inotify.add_watch(dirname, self._mask)
+            except OSError:
+                continue
+            self._directories[wd] = dirname
+
+    def _is_watched(self, path):
+        from fnmatch import fnmatchcase
+
+        return path in self._paths or any(
+            fnmatchcase(path, pattern) for pattern in self._patterns)
+
+    def wait(self, timeout=None):
+        deadline = (None if timeout is None
+                    else time.monotonic() + timeout)
+        while True:
+            read_timeout = None
+            if deadline is not None:
+                read_timeout = max(int(
+                    (deadline - time.monotonic()) * 1000), 0)
+            changed = set()
+            for event in self._inotify.read(timeout=read_timeout):
+                dirname = self._directories.get(event.wd)
+                if dirname is None or not event.name:
+                    continue
+                path = os.path.join(dirname, event.name)
+                if self._is_watched(path):
+                    changed.add(path)
+            if changed:
+                return sorted(changed)
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+
+    def close(self):
+        self._inotify.close()
+
+
+def get_watcher(poll=False, interval=DEFAULT_POLL_INTERVAL):
+    """Return an InotifyWatcher, or a PollingWatcher if poll is true or
+
+    inotify is not available.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher()
+        except (ImportError, OSError):
+            pass
+    return PollingWatcher(interval)
+
+
+def _get_patterns(json_fn, base_dir):
+    """Return the globs of the chapters of the book json_fn."""
+    try:
+        with open(json_fn, 'rb') as file_handle:
+            json_data = json.load(file_handle)
+        return [
+            os.path.join(base_dir or '', item['source'])
+            for item in json_data['contents']
+            if not item.get('generate', (item['type'] == 'toc')) and
+            '*' in item['source']
+        ]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def watch_book(maker, json_fn, output_filename, base_dir=None,
+               debounce=DEFAULT_DEBOUNCE, watcher=None, on_build=None,
+               on_error=None, max_builds=None):
+    """Build json_fn into output_filename and rebuild it on changes.
+
+    maker is the EbookMaker, which gets a MemoryScanCache if it has no
+    scan cache, and watcher is a PollingWatcher or an InotifyWatcher (by
+    default the one of get_watcher()).  on_build(stats, changed) is
+    called after every build with its BuildStats and the list of the
+    changed paths which caused it (empty for the first build), and
+    on_error(exception, changed) after every failed one (by default the
+    exception is raised).
+    Returns after max_builds builds, if it is not None.
+    """
+    if maker.scan_cache is None:
+        maker.scan_cache = MemoryScanCache()
+    own_watcher = (watcher is None)
+    if own_watcher:
+        watcher = get_watcher()
+    inputs = [json_fn]
+    changed = []
+    builds = 0
+    try:
+        watcher.watch(inputs, _get_patterns(json_fn, base_dir))
+        while True:
+            try:
+                stats = maker.make_epub(
+                    json_fn, output_filename, incremental=True,
+                    base_dir=base_dir)
+            except Exception as err:
+                if on_error is None:
+                    raise
+                on_error(err, changed)
+            else:
+                inputs = stats.inputs
+                if on_build is not None:
+                    on_build(stats, changed)
+            builds += 1
+            if max_builds is not None and builds >= max_builds:
+                return
+            # After a failure, the inputs of the last successful build
+            # (or the JSON) are watched.
+            watcher.watch(
+                set(inputs) | set([json_fn]),
+                _get_patterns(json_fn, base_dir))
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(timeout=debounce)
+                if not more:
+                    break
+                changed = sorted(set(changed) | set(more))
+    finally:
+        if own_watcher:
+            watcher.close()
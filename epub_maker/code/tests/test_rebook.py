@@ -8,9 +8,1139 @@ test_rebook
 Tests for `rebookmaker` module.
 """
 
+import os
+from zipfile import ZipFile
+
 import pytest  # noqa: F401
 
+XHTML_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" \
+"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
+<head>
+<title>{title}</title>
+</head>
+<body>
+<section class="scene" id="scene-{idx}">
+<header><h2 id="scene-{idx}-title">Scene {idx} &amp; <b>more</b></h2></header>
+<p>Some text.<img src="{image}" alt="" /></p>
+<h3 id="scene-{idx}-sub">Sub <![CDATA[heading]]></h3>
+<h3>No id</h3>
+<p>More text.</p>
+</section>
+</body>
+</html>
+'''
+
+
+def _write_book(dirname, num_scenes=3):
+    """Write a small book into dirname and return its JSON data."""
+    os.makedirs(os.path.join(dirname, 'images'), exist_ok=True)
+    for fn, data in [
+        ('style.css', b'body { margin: 0; }\n'),
+        ('cover.png', b'\x89PNG cover'),
+        ('images/dice.png', b'\x89PNG dice'),
+        ('images/fish.jpg', b'\xff\xd8 fish'),
+    ]:
+        with open(os.path.join(dirname, fn), 'wb') as fh:
+            fh.write(data)
+    for idx in range(num_scenes):
+        with open(os.path.join(dirname, 'scene-{:04d}.xhtml'.format(idx)),
+                  'wt') as fh:
+            fh.write(XHTML_TEMPLATE.format(
+                idx=idx, title='Scene {}'.format(idx),
+                image=('images/dice.png' if idx % 2 else 'images/fish.jpg'),
+            ))
+    return {
+        'authors': [{'name': 'Jane Doe', 'sort': 'Doe, Jane'}],
+        'contents': [
+            {'type': 'toc', 'source': 'toc.html'},
+            {'type': 'text', 'source': 'scene-*.xhtml'},
+        ],
+        'cover': 'cover.png',
+        'identifier': {'scheme': 'URL', 'value': 'https://example.com/'},
+        'language': 'en-GB',
+        'publisher': 'Example',
+        'rights': 'CC-BY',
+        'title': 'A Test Book',
+        'toc': {'depth': 3, 'parse': ['text'],
+                'generate': {'title': 'Index'}},
+    }
+
+
+def _members(epub_fn):
+    with ZipFile(epub_fn) as zip_obj:
+        return [(info.filename, zip_obj.read(info))
+                for info in zip_obj.infolist()]
+
+
+def _load_cli():
+    """Load the main() of the rebookmaker script."""
+    import importlib.machinery
+    import importlib.util
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'rebookmaker', 'rebookmaker')
+    loader = importlib.machinery.SourceFileLoader('rebookmaker_cli', path)
+    spec = importlib.util.spec_from_loader('rebookmaker_cli', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module.main
+
 
 def test_rebookmaker():
     import rebookmaker
     assert rebookmaker.EbookMaker()
+
+
+def test_stream_scanner_matches_bs4(tmp_path, monkeypatch):
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    outputs = {}
+    for scanner in ['stream', 'bs4']:
+        out_fn = str(tmp_path / (scanner + '.epub'))
+        rebookmaker.EbookMaker(scanner=scanner).make_epub_from_data(
+            json_data, out_fn)
+        outputs[scanner] = _members(out_fn)
+    assert outputs['stream'] == outputs['bs4']
+    members = dict(outputs['stream'])
+    assert 'OEBPS/images/dice.png' in members
+    assert b'Scene 1 &amp; more' in members['OEBPS/toc.ncx']
+    assert b'scene-0002.xhtml#scene-2-sub' in members['OEBPS/toc.ncx']
+    assert b'No id' not in members['OEBPS/toc.ncx']
+
+
+def test_stream_scan_records():
+    from rebookmaker.scanner import stream_scan
+    images, page_nav = stream_scan(
+        text=XHTML_TEMPLATE.format(idx=5, title='T', image='a.png'),
+        html_src='s.xhtml', h_tags=('h1', 'h2'),
+    )
+    assert images == ['a.png']
+    assert page_nav == [(2, 's.xhtml#scene-5-title', 'Scene 5 & more')]
+
+
+def test_chapters_are_read_once(tmp_path, monkeypatch):
+    import builtins
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    opened = []
+    real_open = builtins.open
+
+    def _counting_open(fn, *args, **kwargs):
+        opened.append(fn)
+        return real_open(fn, *args, **kwargs)
+    monkeypatch.setattr(builtins, 'open', _counting_open)
+    out_fn = str(tmp_path / 'book.epub')
+    rebookmaker.EbookMaker().make_epub_from_data(json_data, out_fn)
+    monkeypatch.setattr(builtins, 'open', real_open)
+    assert opened.count('scene-0001.xhtml') == 1
+    members = dict(_members(out_fn))
+    with open('scene-0001.xhtml', 'rt') as fh:
+        expected = rebookmaker.STRIP_DOCTYPE__REGEX.sub("\\1", fh.read())
+    assert members['OEBPS/scene-0001.xhtml'] == expected.encode('utf-8')
+
+
+def test_process_pool_keeps_the_order(tmp_path, monkeypatch):
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=12)
+    outputs = []
+    for workers in [None, 3]:
+        out_fn = str(tmp_path / 'book{}.epub'.format(workers))
+        rebookmaker.EbookMaker(workers=workers).make_epub_from_data(
+            json_data, out_fn)
+        outputs.append(_members(out_fn))
+    assert outputs[0] == outputs[1]
+    names = [name for name, _ in outputs[1]]
+    scenes = [name for name in names if 'scene-' in name]
+    assert scenes == sorted(scenes) and len(scenes) == 12
+
+
+def test_parallel_compression_is_deterministic(tmp_path, monkeypatch):
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=9)
+    outputs = []
+    for threads in [None, 4, 4]:
+        out_fn = str(tmp_path / 'book{}.epub'.format(len(outputs)))
+        rebookmaker.EbookMaker(
+            compression=ZIP_DEFLATED, compress_threads=threads,
+        ).make_epub_from_data(json_data, out_fn)
+        with open(out_fn, 'rb') as fh:
+            outputs.append(fh.read())
+    assert outputs[0] == outputs[1] == outputs[2]
+    with ZipFile(str(tmp_path / 'book1.epub')) as zip_obj:
+        assert zip_obj.testzip() is None
+        infos = zip_obj.infolist()
+        assert infos[0].filename == 'mimetype'
+        assert infos[0].compress_type == rebookmaker.ZIP_STORED
+        assert zip_obj.getinfo('OEBPS/toc.ncx').compress_type == ZIP_DEFLATED
+
+
+def test_scan_cache(tmp_path, monkeypatch):
+    import rebookmaker
+    from rebookmaker import scanner
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=4)
+    cache_dir = str(tmp_path / 'cache')
+    out_fn = str(tmp_path / 'book.epub')
+    rebookmaker.EbookMaker(cache_dir=cache_dir).make_epub_from_data(
+        json_data, out_fn)
+    expected = _members(out_fn)
+    with open('scene-0003.xhtml', 'at') as fh:
+        fh.write('\n')
+    scanned = []
+    real_scan = scanner.stream_scan
+
+    def _recording_scan(text, html_src, h_tags):
+        scanned.append(html_src)
+        return real_scan(text=text, html_src=html_src, h_tags=h_tags)
+    monkeypatch.setattr(scanner, 'stream_scan', _recording_scan)
+    maker = rebookmaker.EbookMaker(cache_dir=cache_dir)
+    maker.make_epub_from_data(json_data, out_fn)
+    assert scanned == ['scene-0003.xhtml']
+    assert (maker.scan_cache.hits, maker.scan_cache.misses) == (3, 1)
+    assert [x for x in _members(out_fn) if 'scene-0003' not in x[0]] == \
+        [x for x in expected if 'scene-0003' not in x[0]]
+    assert maker.scan_cache.stats()['entries'] == 5
+    # The cache directory is walked once, and then only above its cap.
+    from rebookmaker.cache import ScanCache
+    walks = []
+    real_entries = ScanCache._entries
+
+    def _recording_entries(self):
+        walks.append(self.cache_dir)
+        return real_entries(self)
+    monkeypatch.setattr(ScanCache, '_entries', _recording_entries)
+    for _ in range(3):
+        maker.make_epub_from_data(json_data, out_fn)
+    assert walks == []
+    max_size = maker.scan_cache.max_size
+    maker.scan_cache.max_size = 1
+    with open('scene-0003.xhtml', 'at') as fh:
+        fh.write('\n')
+    maker.make_epub_from_data(json_data, out_fn)
+    assert len(walks) == 1
+    monkeypatch.setattr(ScanCache, '_entries', real_entries)
+    assert maker.scan_cache.stats()['entries'] == 0
+    maker.scan_cache.max_size = max_size
+    maker.make_epub_from_data(json_data, out_fn)
+    assert maker.scan_cache.prune(max_size=0) == 4
+
+
+def test_incremental_rebuild(tmp_path, monkeypatch):
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    from rebookmaker.archive import ArchiveWriter
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=5)
+    maker = rebookmaker.EbookMaker(compression=ZIP_DEFLATED)
+    maker.make_epub_from_data(json_data, 'book.epub')
+    with open('scene-0002.xhtml', 'at') as fh:
+        fh.write('<!-- changed -->\n')
+    reused = []
+    real_close = ArchiveWriter.close
+
+    def _close(self):
+        reused.append(self.reused)
+        return real_close(self)
+    monkeypatch.setattr(ArchiveWriter, 'close', _close)
+    maker.make_epub_from_data(json_data, 'book.epub', incremental=True)
+    maker.make_epub_from_data(json_data, 'full.epub')
+    with open('book.epub', 'rb') as fh, open('full.epub', 'rb') as fh2:
+        assert fh.read() == fh2.read()
+    # Everything except the changed chapter.
+    assert reused[0] == len(_members('full.epub')) - 1
+    assert reused[1] == 0
+    assert [fn for fn in os.listdir('.') if fn.startswith('.tmp-')] == []
+
+
+def test_batch(tmp_path, monkeypatch):
+    import json
+    from click.testing import CliRunner
+    monkeypatch.chdir(tmp_path)
+    main = _load_cli()
+    json_data = _write_book(str(tmp_path))
+    for fn in ['one.json', 'two.json']:
+        with open(fn, 'wt') as fh:
+            json.dump(json_data, fh)
+    result = CliRunner().invoke(
+        main, ['--output', 'legacy.epub', 'one.json'])
+    assert result.exit_code == 0, result.output
+    with open('books.json', 'wt') as fh:
+        json.dump([{'json': 'one.json'},
+                   {'json': 'two.json', 'output': 'out/two.epub'}], fh)
+    os.mkdir('out')
+    result = CliRunner().invoke(main, ['batch', 'books.json'])
+    assert result.exit_code == 0, result.output
+    assert _members('one.epub') == _members('out/two.epub') == \
+        _members('legacy.epub')
+
+    from rebookmaker.batch import BatchJob, build_batch
+    errors = build_batch([BatchJob('one.json'), BatchJob('missing.json')])
+    assert errors[0] is None
+    assert 'missing.json' in errors[1]
+    # The caches are pruned once, after all the books.
+    from rebookmaker.cache import ScanCache
+    prunes = []
+    monkeypatch.setattr(ScanCache, 'prune',
+                        lambda self, max_size=None: prunes.append(self))
+    assert build_batch([BatchJob('one.json'), BatchJob('two.json')],
+                       workers=2, cache_dir=str(tmp_path / 'cache')) == \
+        [None, None]
+    assert len(prunes) == 1
+
+
+def test_asset_cache_is_shared(tmp_path, monkeypatch):
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    from rebookmaker.archive import AssetCache
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    asset_cache = AssetCache()
+    maker = rebookmaker.EbookMaker(
+        compression=ZIP_DEFLATED, asset_cache=asset_cache)
+    maker.make_epub_from_data(json_data, 'one.epub')
+    assert (asset_cache.hits, asset_cache.misses) == (0, 1)
+    maker.make_epub_from_data(json_data, 'two.epub')
+    assert (asset_cache.hits, asset_cache.misses) == (1, 1)
+    with open('one.epub', 'rb') as fh, open('two.epub', 'rb') as fh2:
+        assert fh.read() == fh2.read()
+
+    # Concurrent misses compress a shared file only once.
+    import threading
+    import time
+    from rebookmaker import archive
+    compress = archive._compress
+    calls = []
+
+    def _slow_compress(*args):
+        calls.append(args)
+        time.sleep(0.2)
+        return compress(*args)
+    monkeypatch.setattr(archive, '_compress', _slow_compress)
+    asset_cache = AssetCache()
+
+    def _write(fn, threads):
+        zip_obj = archive.ArchiveWriter(
+            fn, threads=threads, asset_cache=asset_cache)
+        zip_obj.writestr('style.css', b'p { margin: 0; }' * 100,
+                         ZIP_DEFLATED, shared=True)
+        zip_obj.close()
+    writers = [
+        threading.Thread(target=_write, args=(fn, threads))
+        for fn, threads in [('three.epub', None), ('four.epub', 2)]
+    ]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert len(calls) == 1
+    assert (asset_cache.hits, asset_cache.misses) == (1, 1)
+    assert _members('three.epub') == _members('four.epub')
+
+
+def test_build_server(tmp_path, monkeypatch):
+    import threading
+    from rebookmaker.server import BuildServer, request_build
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    import json
+    with open('book.json', 'wt') as fh:
+        json.dump(json_data, fh)
+    socket_path = str(tmp_path / 'rebookmaker.sock')
+    server = BuildServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        import time
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        request_build(socket_path, 'book.json', 'served.epub',
+                      directory=str(tmp_path))
+        with pytest.raises(RuntimeError):
+            request_build(socket_path, 'missing.json', 'x.epub',
+                          directory=str(tmp_path))
+        # A second server must not take over the socket of a live one.
+        with pytest.raises(FileExistsError):
+            BuildServer(socket_path).serve_forever()
+        request_build(socket_path, 'book.json', 'served.epub',
+                      directory=str(tmp_path))
+    finally:
+        server.shutdown()
+        thread.join()
+    assert not os.path.exists(socket_path)
+    # Nor remove anything but a socket.
+    with open(socket_path, 'wt') as fh:
+        fh.write('not a socket')
+    with pytest.raises(FileExistsError):
+        BuildServer(socket_path).serve_forever()
+    assert os.path.isfile(socket_path)
+    os.unlink(socket_path)
+    # The socket of a server which is no longer running is stale.
+    import socket
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    server = BuildServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        for _ in range(100):
+            try:
+                request_build(socket_path, 'book.json', 'stale.epub',
+                              directory=str(tmp_path))
+                break
+            except OSError:
+                time.sleep(0.05)
+    finally:
+        server.shutdown()
+        thread.join()
+    assert 'OEBPS/toc.ncx' in dict(_members('stale.epub'))
+    assert 'OEBPS/toc.ncx' in dict(_members('served.epub'))
+
+
+# The cumulative import time budget of the rebookmaker module.
+IMPORT_TIME_BUDGET_USEC = 250000
+
+
+def test_import_time_budget():
+    import subprocess
+    import sys
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import rebookmaker'],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    imported = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        imported[name.strip()] = int(cumulative)
+    for heavy in ['bs4', 'lxml', 'jinja2', 'markupsafe',
+                  'importlib_resources']:
+        assert heavy not in imported
+    assert imported['rebookmaker'] < IMPORT_TIME_BUDGET_USEC
+
+
+def test_templates_are_loaded_once(tmp_path, monkeypatch):
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    rebookmaker.EbookMaker().make_epub_from_data(json_data, 'one.epub')
+    templates = rebookmaker._get_templates()
+    rebookmaker.EbookMaker().make_epub_from_data(json_data, 'two.epub')
+    assert rebookmaker._get_templates() is templates
+
+
+def test_nav_points_rendering():
+    from rebookmaker import _render_nav_points
+    ncx, xhtml, toc_html = _render_nav_points([
+        [(2, 'a.xhtml#x', 'X & <Y>'), (3, 'a.xhtml#y', 'Y'),
+         (2, 'a.xhtml#z', 'Z')],
+        [],
+    ])
+    assert str(ncx) == (
+        '<navPoint id="nav1" playOrder="1">\n'
+        '    <navLabel><text>X &amp; &lt;Y&gt;</text></navLabel>\n'
+        '    <content src="a.xhtml#x"/>\n'
+        '    <navPoint id="nav2" playOrder="2">\n'
+        '        <navLabel><text>Y</text></navLabel>\n'
+        '        <content src="a.xhtml#y"/>\n'
+        '    </navPoint>\n'
+        '</navPoint>\n'
+        '<navPoint id="nav3" playOrder="3">\n'
+        '    <navLabel><text>Z</text></navLabel>\n'
+        '    <content src="a.xhtml#z"/>\n'
+        '</navPoint>\n'
+    )
+    assert str(xhtml) == (
+        '<li>\n<a href="a.xhtml#x">X &amp; &lt;Y&gt;</a>\n'
+        '<ol>    <li>\n    <a href="a.xhtml#y">Y</a>\n    </li>\n</ol>'
+        '</li>\n'
+        '<li>\n<a href="a.xhtml#z">Z</a>\n</li>\n'
+    )
+    assert str(toc_html) == (
+        '<div style="margin-top: 1em;">\n'
+        '<p style="text-indent: 1em;">'
+        '<a href="a.xhtml#x">X &amp; &lt;Y&gt;</a></p>\n'
+        '<p style="text-indent: 2em;"><a href="a.xhtml#y">Y</a></p>\n'
+        '<p style="text-indent: 1em;"><a href="a.xhtml#z">Z</a></p>\n'
+        '</div>\n'
+        '<div style="margin-top: 1em;">\n'
+        '</div>\n'
+    )
+
+
+def test_nav_points_stress():
+    import time
+    from rebookmaker import _render_nav_points
+    nav_points = [
+        [((idx % 6) + 1, 'f{}.xhtml#h{}'.format(file_idx, idx),
+          'Heading {}'.format(idx)) for idx in range(100)]
+        for file_idx in range(1000)
+    ]
+    start = time.time()
+    ncx, xhtml, toc_html = _render_nav_points(nav_points)
+    assert time.time() - start < 10
+    assert ncx.count('<navPoint ') == ncx.count('</navPoint>') == 100000
+    assert xhtml.count('<li>') == xhtml.count('</li>') == 100000
+    assert 'playOrder="100000"' in ncx
+    assert toc_html.count('<p ') == 100000
+
+
+class _NonSeekableStream:
+    """A write-only stream such as a pipe or a socket."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def test_file_object_outputs(tmp_path, monkeypatch):
+    import io
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    maker = rebookmaker.EbookMaker(compression=ZIP_DEFLATED)
+    maker.make_epub_from_data(json_data, 'book.epub')
+    with open('book.epub', 'rb') as fh:
+        expected = fh.read()
+    buf = io.BytesIO()
+    maker.make_epub_from_data(json_data, buf)
+    assert buf.getvalue() == expected
+    stream = _NonSeekableStream()
+    maker.make_epub_from_data(json_data, stream)
+    with ZipFile(io.BytesIO(b''.join(stream.chunks))) as zip_obj:
+        assert zip_obj.testzip() is None
+        infos = zip_obj.infolist()
+        assert infos[0].filename == 'mimetype'
+        assert [(info.flag_bits & 0x08) for info in infos] == \
+            [0] * len(infos)
+        assert [(info.filename, zip_obj.read(info)) for info in infos] == \
+            _members('book.epub')
+
+
+def test_input_providers(tmp_path, monkeypatch):
+    import io
+    import json
+    import tarfile
+    from click.testing import CliRunner
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    from rebookmaker.providers import ArchiveProvider, DirectoryProvider, \
+        MemoryProvider
+    src_dir = tmp_path / 'src'
+    json_data = _write_book(str(src_dir))
+    monkeypatch.chdir(src_dir)
+    maker = rebookmaker.EbookMaker(compression=ZIP_DEFLATED, workers=2)
+    maker.make_epub_from_data(json_data, str(tmp_path / 'cwd.epub'))
+    expected = _members(str(tmp_path / 'cwd.epub'))
+    monkeypatch.chdir(tmp_path)
+    files = {}
+    for dirpath, _dirnames, filenames in os.walk(str(src_dir)):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            with open(path, 'rb') as fh:
+                files[os.path.relpath(path, str(src_dir))] = fh.read()
+    with ZipFile('src.zip', 'w') as zip_obj:
+        for name, data in files.items():
+            zip_obj.writestr('book/' + name, data)
+    with tarfile.open('src.tar.gz', 'w:gz') as tar_obj:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar_obj.addfile(info, io.BytesIO(data))
+    # Like "tar -cf src-dot.tar ." .
+    with tarfile.open('src-dot.tar', 'w') as tar_obj:
+        for name, data in files.items():
+            info = tarfile.TarInfo('./book/' + name)
+            info.size = len(data)
+            tar_obj.addfile(info, io.BytesIO(data))
+    for provider in [
+        DirectoryProvider(str(src_dir)),
+        MemoryProvider(files),
+        ArchiveProvider('src.zip', prefix='book'),
+        ArchiveProvider('src.tar.gz'),
+        ArchiveProvider('src-dot.tar', prefix='./book/'),
+    ]:
+        maker.make_epub_from_data(json_data, 'book.epub', provider=provider)
+        provider.close()
+        assert _members('book.epub') == expected
+    with open('book.json', 'wt') as fh:
+        json.dump(json_data, fh)
+    result = CliRunner().invoke(_load_cli(), [
+        '--output', 'cli.epub',
+        '--input-archive', 'src-dot.tar', '--input-prefix', 'book',
+        'book.json'])
+    assert result.exit_code == 0, result.output
+    assert _members('cli.epub') == expected
+    # Streams of tar members can be read by several threads at once.
+    from concurrent.futures import ThreadPoolExecutor
+    with tarfile.open('many.tar', 'w') as tar_obj:
+        for idx in range(8):
+            data = bytes([idx]) * (1 << 16)
+            info = tarfile.TarInfo('f{}.bin'.format(idx))
+            info.size = len(data)
+            tar_obj.addfile(info, io.BytesIO(data))
+    provider = ArchiveProvider('many.tar')
+
+    def _read(idx):
+        with provider.open('f{}.bin'.format(idx % 8)) as fh:
+            return b''.join(iter(lambda: fh.read(512), b'')) == \
+                bytes([idx % 8]) * (1 << 16)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert all(executor.map(_read, range(64)))
+    provider.close()
+    provider = MemoryProvider({
+        'a.xhtml': '', 'b/c.xhtml': '', '.d.xhtml': '', 'e.html': ''})
+    assert provider.glob('*.xhtml') == ['a.xhtml']
+    assert provider.glob('*/*.xhtml') == ['b/c.xhtml']
+    assert provider.glob('.*') == ['.d.xhtml']
+    with pytest.raises(FileNotFoundError):
+        provider.read_bytes('missing.png')
+
+
+def test_concurrent_builds_with_a_shared_maker(tmp_path, monkeypatch):
+    import copy
+    from concurrent.futures import ThreadPoolExecutor
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    books = []
+    for idx in range(6):
+        book_dir = str(tmp_path / 'book{}'.format(idx))
+        json_data = _write_book(book_dir, num_scenes=(2 + idx))
+        json_data['title'] = 'Book {}'.format(idx)
+        books.append((book_dir, json_data, copy.deepcopy(json_data)))
+    # The sources must be found through base_dir and not the cwd.
+    os.mkdir(str(tmp_path / 'elsewhere'))
+    monkeypatch.chdir(tmp_path / 'elsewhere')
+    maker = rebookmaker.EbookMaker(
+        compression=ZIP_DEFLATED, compress_threads=2)
+    expected = []
+    for book_dir, json_data, _orig in books:
+        fn = os.path.join(book_dir, 'serial.epub')
+        maker.make_epub_from_data(json_data, fn, base_dir=book_dir)
+        expected.append(_members(fn))
+
+    def _build(task):
+        idx, (book_dir, json_data, _orig) = task
+        fn = os.path.join(book_dir, 'parallel{}.epub'.format(idx))
+        maker.make_epub_from_data(json_data, fn, base_dir=book_dir)
+        return _members(fn)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(_build, enumerate(books * 3))) == \
+            expected * 3
+    for _book_dir, json_data, orig in books:
+        assert json_data == orig
+    assert os.listdir('.') == []
+
+
+def test_benchmark_harness(tmp_path):
+    import copy
+    from rebookmaker.bench import CorpusSpec, check_regressions, \
+        generate_corpus, make_report, run_benchmark
+    spec = CorpusSpec(chapters=5, chapter_size=2000, images=3,
+                      image_size=100)
+    json_data = generate_corpus(str(tmp_path), spec)
+    assert len(os.listdir(str(tmp_path / 'chapters'))) == 5
+    report = make_report(spec, run_benchmark(
+        json_data, str(tmp_path), repeat=1))
+    stored = report['results']['ZIP_STORED']
+    deflated = report['results']['ZIP_DEFLATED']
+    assert deflated['output_size'] < stored['output_size']
+    assert stored['wall_time'] > 0 and stored['peak_memory'] > 0
+    assert check_regressions(report, report) == []
+    baseline = copy.deepcopy(report)
+    baseline['results']['ZIP_STORED']['output_size'] //= 2
+    regressions = check_regressions(report, baseline, tolerance=0.1)
+    assert len(regressions) == 1
+    assert regressions[0].startswith('ZIP_STORED: output_size')
+
+
+def test_build_stats(tmp_path, monkeypatch):
+    import io
+    from zipfile import ZIP_DEFLATED
+    import rebookmaker
+    from rebookmaker.stats import PHASES
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=4)
+    hooked = []
+    maker = rebookmaker.EbookMaker(
+        compression=ZIP_DEFLATED, stats_hook=hooked.append)
+    stats = maker.make_epub_from_data(json_data, 'book.epub')
+    assert hooked == [stats]
+    assert sorted(stats.phases) == sorted(PHASES)
+    assert stats.bytes_written == os.path.getsize('book.epub')
+    assert stats.headings == 8
+    assert stats.images == 3
+    assert stats.media_types['image/png'] == [
+        len(b'\x89PNG cover') + len(b'\x89PNG dice')] * 2
+    assert stats.compression_ratios()['application/xhtml+xml'] < 1
+    assert sorted(src for _seconds, src in stats.slowest_sources(10)) == \
+        ['scene-{:04d}.xhtml'.format(idx) for idx in range(4)]
+    assert len(stats.slowest_sources(2)) == 2
+    assert 'slowest sources:' in stats.summary()
+    buf = io.BytesIO(b'prefix')
+    buf.seek(0, io.SEEK_END)
+    stats = maker.make_epub_from_data(json_data, buf)
+    assert stats.bytes_written == len(buf.getvalue()) - len(b'prefix')
+
+
+def test_depfile_and_only_if_changed(tmp_path, monkeypatch):
+    import json
+    from zipfile import ZIP_DEFLATED
+    from click.testing import CliRunner
+    import rebookmaker
+    from rebookmaker.depfile import format_depfile
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=2)
+    with open('book.json', 'wt') as fh:
+        json.dump(json_data, fh)
+    result = CliRunner().invoke(_load_cli(), [
+        '--output', 'book.epub', '--depfile', 'book.epub.d', 'book.json'])
+    assert result.exit_code == 0, result.output
+    with open('book.epub.d', 'rt') as fh:
+        depfile_text = fh.read()
+    stats = rebookmaker.EbookMaker().make_epub('book.json', 'other.epub')
+    assert stats.inputs[:6] == [
+        'book.json', 'scene-0000.xhtml', 'scene-0001.xhtml', 'style.css',
+        'images/dice.png', 'images/fish.jpg']
+    assert stats.inputs[6:] == ['cover.png'] + \
+        rebookmaker.get_template_paths()
+    assert depfile_text == format_depfile('book.epub', stats.inputs)
+    assert format_depfile('my book.epub', ['a$b#c']) == \
+        'my\\ book.epub: \\\n a$$b\\#c\n\na$$b\\#c:\n'
+
+    os.utime('book.epub', (1000000000, 1000000000))
+    maker = rebookmaker.EbookMaker(compression=ZIP_DEFLATED)
+    stats = maker.make_epub('book.json', 'book.epub', only_if_changed=True)
+    assert stats.output_unchanged
+    assert os.stat('book.epub').st_mtime == 1000000000
+    json_data['title'] = 'A Changed Title'
+    stats = maker.make_epub_from_data(
+        json_data, 'book.epub', only_if_changed=True)
+    assert not stats.output_unchanged
+    assert os.stat('book.epub').st_mtime != 1000000000
+    assert sorted(os.listdir('.')) == sorted([
+        'book.epub', 'book.epub.d', 'book.json', 'cover.png', 'images',
+        'other.epub', 'scene-0000.xhtml', 'scene-0001.xhtml', 'style.css'])
+
+
+def test_output_cache(tmp_path, monkeypatch):
+    import json
+    from zipfile import ZIP_DEFLATED
+    from click.testing import CliRunner
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path))
+    cache_dir = str(tmp_path / 'output-cache')
+    maker = rebookmaker.EbookMaker(
+        compression=ZIP_DEFLATED, output_cache_dir=cache_dir)
+    stats = maker.make_epub_from_data(json_data, 'first.epub')
+    assert not stats.output_cache_hit
+    stats = maker.make_epub_from_data(json_data, 'second.epub')
+    assert stats.output_cache_hit
+    assert stats.inputs[-len(rebookmaker.get_template_paths()) - 1:] == \
+        ['cover.png'] + rebookmaker.get_template_paths()
+    with open('first.epub', 'rb') as fh:
+        first = fh.read()
+    with open('second.epub', 'rb') as fh:
+        assert fh.read() == first
+    # A hit gets the same permissions as a miss, and keeps the ones of
+    # an existing output.
+    old_umask = os.umask(0o022)
+    try:
+        os.unlink('second.epub')
+        assert maker.make_epub_from_data(
+            json_data, 'second.epub').output_cache_hit
+        assert not rebookmaker.EbookMaker(
+            compression=ZIP_DEFLATED,
+            output_cache_dir=str(tmp_path / 'other-cache'),
+        ).make_epub_from_data(json_data, 'miss.epub').output_cache_hit
+        assert os.stat('second.epub').st_mode == \
+            os.stat('miss.epub').st_mode == 0o100644
+        os.chmod('second.epub', 0o640)
+        assert maker.make_epub_from_data(
+            json_data, 'second.epub').output_cache_hit
+        assert os.stat('second.epub').st_mode & 0o777 == 0o640
+    finally:
+        os.umask(old_umask)
+    # A changed image is a miss.
+    with open('images/dice.png', 'wb') as fh:
+        fh.write(b'\x89PNG other dice')
+    stats = maker.make_epub_from_data(json_data, 'third.epub')
+    assert not stats.output_cache_hit
+    assert _members('third.epub') != _members('first.epub')
+    # So is a different compression.
+    stats = rebookmaker.EbookMaker(output_cache_dir=cache_dir) \
+        .make_epub_from_data(json_data, 'stored.epub')
+    assert not stats.output_cache_hit
+    assert (maker.output_cache.hits, maker.output_cache.misses) == (3, 2)
+    linker = rebookmaker.EbookMaker(
+        compression=ZIP_DEFLATED, output_cache_dir=cache_dir,
+        output_cache_link=True)
+    assert linker.make_epub_from_data(json_data, 'linked.epub') \
+        .output_cache_hit
+    assert os.stat('linked.epub').st_nlink == 2
+    # Rebuilding it after a change must not corrupt the cached copy.
+    json_data['title'] = 'Another Title'
+    linker.make_epub_from_data(json_data, 'linked.epub')
+    assert os.stat('linked.epub').st_nlink == 1
+    json_data['title'] = 'A Test Book'
+    assert linker.make_epub_from_data(json_data, 'linked.epub') \
+        .output_cache_hit
+    assert os.stat('linked.epub').st_mode & 0o222 == 0
+    # And neither must an ordinary build into the hard link.
+    json_data['title'] = 'Yet Another Title'
+    rebookmaker.EbookMaker(compression=ZIP_DEFLATED).make_epub_from_data(
+        json_data, 'linked.epub', incremental=True)
+    assert os.stat('linked.epub').st_nlink == 1
+    assert os.stat('linked.epub').st_mode & 0o222
+    json_data['title'] = 'A Test Book'
+    maker.make_epub_from_data(json_data, 'again.epub')
+    assert _members('again.epub') == _members('third.epub')
+
+    main = _load_cli()
+    result = CliRunner().invoke(
+        main, ['cache', 'stats', '--output-cache', cache_dir])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output.split(': ', 1)[1])['objects'][
+        'entries'] == 4
+    result = CliRunner().invoke(main, [
+        'cache', 'prune', '--output-cache', cache_dir, '--max-size', '0'])
+    assert result.exit_code == 0, result.output
+    assert result.output == "output cache: deleted 4 entries\n"
+
+
+def test_compression_profiles(tmp_path, monkeypatch):
+    from zipfile import ZIP_DEFLATED, ZIP_STORED
+    import rebookmaker
+    from rebookmaker.compression import get_profile
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=6)
+    with open('images/dice.png', 'wb') as fh:
+        fh.write(b'\x89PNG' + b'\0' * 4096)
+    expected = None
+    sizes = {}
+    for name in ['fast', 'balanced', 'smallest']:
+        fn = name + '.epub'
+        stats = rebookmaker.EbookMaker(compression_profile=name) \
+            .make_epub_from_data(json_data, fn)
+        assert stats.compression_profile == name
+        if expected is None:
+            expected = _members(fn)
+        assert _members(fn) == expected
+        with ZipFile(fn) as zip_obj:
+            types = dict(
+                (info.filename, info.compress_type)
+                for info in zip_obj.infolist())
+        assert types['mimetype'] == ZIP_STORED
+        assert types['OEBPS/scene-0000.xhtml'] == ZIP_DEFLATED
+        # The tiny JPEG does not shrink, and the fast profile stores
+        # all the images.
+        assert types['OEBPS/images/fish.jpg'] == ZIP_STORED
+        assert types['OEBPS/images/dice.png'] == \
+            (ZIP_STORED if name == 'fast' else ZIP_DEFLATED)
+        sizes[name] = stats.bytes_written
+        assert stats.stored_uncompressible > 0
+    assert sizes['smallest'] <= sizes['balanced'] < sizes['fast']
+    profile = get_profile('fast').with_levels({'image/png': 9})
+    rebookmaker.EbookMaker(compression_profile=profile) \
+        .make_epub_from_data(json_data, 'custom.epub')
+    with ZipFile('custom.epub') as zip_obj:
+        assert zip_obj.getinfo('OEBPS/images/dice.png').compress_type == \
+            ZIP_DEFLATED
+    with pytest.raises(ValueError):
+        get_profile('tiniest')
+    pytest.importorskip('zopfli.zlib')
+    rebookmaker.EbookMaker(compression_profile='maximum') \
+        .make_epub_from_data(json_data, 'maximum.epub')
+    assert _members('maximum.epub') == expected
+    assert os.path.getsize('maximum.epub') <= sizes['smallest']
+
+
+def test_streaming_large_chapters_and_images(tmp_path, monkeypatch):
+    import tracemalloc
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=3)
+    paragraph = '<p>Some more text, שלום.</p>\r\n'
+    with open('scene-0001.xhtml', 'rb') as fh:
+        text = fh.read().decode('utf-8').replace('\n', '\r\n')
+    text = text.replace(
+        '<p>More text.</p>', paragraph * 20000 + '<h3 id="last">Last</h3>')
+    with open('scene-0001.xhtml', 'wb') as fh:
+        fh.write(text.encode('utf-8'))
+    with open('images/dice.png', 'wb') as fh:
+        fh.write(b'\x89PNG' + os.urandom(1 << 20))
+    whole = rebookmaker.EbookMaker(stream_threshold=None) \
+        .make_epub_from_data(json_data, 'whole.epub')
+    tracemalloc.start()
+    try:
+        streamed = rebookmaker.EbookMaker(stream_threshold=(64 << 10)) \
+            .make_epub_from_data(json_data, 'streamed.epub')
+        _current, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    with open('whole.epub', 'rb') as fh:
+        expected = fh.read()
+    with open('streamed.epub', 'rb') as fh:
+        assert fh.read() == expected
+    assert streamed.headings == whole.headings
+    assert streamed.bytes_read == whole.bytes_read
+    assert peak_memory < (1 << 20)
+    member = dict(_members('streamed.epub'))['OEBPS/scene-0001.xhtml']
+    assert b'\r' not in member and member.endswith(b'</html>\n')
+
+
+def test_streamed_rendering_trailing_newlines():
+    import rebookmaker
+    for text in ['', '\n', 'a', 'a\n', 'a\r\n\n', 'a\nb', '\n\na\n\r\n']:
+        expected = rebookmaker.RE.sub("\n", text)
+        for size in range(1, 4):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+            assert ''.join(
+                rebookmaker._normalize_trailing_newlines(chunks)) == \
+                expected
+
+
+def test_validation(tmp_path, monkeypatch):
+    import io
+    from click.testing import CliRunner
+    import rebookmaker
+    from rebookmaker.validate import ValidationError
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=4)
+    maker = rebookmaker.EbookMaker(validate=True)
+    maker.make_epub_from_data(json_data, 'good.epub')
+    rebookmaker.EbookMaker().make_epub_from_data(json_data, 'plain.epub')
+    assert _members('good.epub') == _members('plain.epub')
+    os.unlink('images/dice.png')
+    with open('scene-0002.xhtml', 'rt') as fh:
+        text = fh.read()
+    with open('scene-0002.xhtml', 'wt') as fh:
+        fh.write(text.replace('id="scene-2-sub"', 'id="scene-2-title"')
+                 .replace('images/fish.jpg', 'cover.png'))
+    json_data['guide'] = [
+        {'type': 'text', 'title': 'Start', 'href': 'scene-0000.xhtml#top'},
+        {'type': 'toc', 'title': 'Index', 'href': 'index.xhtml'},
+    ]
+    with pytest.raises(ValidationError) as excinfo:
+        maker.make_epub_from_data(json_data, 'bad.epub')
+    assert sorted(excinfo.value.problems) == sorted([
+        "Duplicate manifest href 'cover.png'",
+        "Missing image 'images/dice.png'",
+        "The guide reference 'index.xhtml' is not in the manifest",
+        "The heading href 'scene-0002.xhtml#scene-2-title' is ambiguous "
+        "(duplicate id)",
+    ])
+    assert not os.path.exists('bad.epub')
+    # Nothing is written before the checks.
+    output = io.BytesIO()
+    with pytest.raises(ValidationError):
+        maker.make_epub_from_data(json_data, output)
+    assert output.getvalue() == b''
+    import json
+    with open('bad.json', 'wt') as fh:
+        json.dump(json_data, fh)
+    result = CliRunner().invoke(
+        _load_cli(), ['build', '--check', '--output', 'bad.epub', 'bad.json'])
+    assert result.exit_code == 1
+    assert "Missing image 'images/dice.png'" in result.output
+
+
+@pytest.mark.parametrize('poll', [True, False])
+def test_watch_mode(tmp_path, monkeypatch, poll):
+    import threading
+    import time
+    import rebookmaker
+    from rebookmaker.watch import get_watcher, watch_book
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=4)
+    import json
+    with open('book.json', 'wt') as fh:
+        json.dump(json_data, fh)
+    watcher = get_watcher(poll=poll, interval=0.02)
+    if not poll and type(watcher).__name__ != 'InotifyWatcher':
+        pytest.skip("inotify is not available")
+    maker = rebookmaker.EbookMaker()
+    builds = []
+    built = threading.Event()
+
+    def _on_build(stats, changed):
+        builds.append(
+            (changed, maker.scan_cache.hits, maker.scan_cache.misses))
+        built.set()
+    thread = threading.Thread(target=watch_book, kwargs=dict(
+        maker=maker, json_fn='book.json', output_filename='book.epub',
+        debounce=0.3, watcher=watcher, on_build=_on_build, max_builds=3))
+    thread.start()
+    try:
+        assert built.wait(10)
+        built.clear()
+        # Several quick saves are a single rebuild.
+        for idx in range(3):
+            with open('scene-0001.xhtml', 'at') as fh:
+                fh.write('<!-- edit {} -->\n'.format(idx))
+            time.sleep(0.02)
+        assert built.wait(10)
+        built.clear()
+        with open('scene-0004.xhtml', 'wt') as fh:
+            fh.write(XHTML_TEMPLATE.format(
+                idx=4, title='Scene 4', image='images/fish.jpg'))
+        assert built.wait(10)
+    finally:
+        thread.join(10)
+        watcher.close()
+    assert not thread.is_alive()
+    assert [len(changed) for changed, _hits, _misses in builds] == [0, 1, 1]
+    assert builds[1][0][0].endswith('scene-0001.xhtml')
+    assert builds[2][0][0].endswith('scene-0004.xhtml')
+    # Only the modified and the new chapters were scanned again.
+    assert [misses for _changed, _hits, misses in builds] == [4, 5, 6]
+    with ZipFile('book.epub') as zip_obj:
+        assert b'edit 2' in zip_obj.read('OEBPS/scene-0001.xhtml')
+        assert b'scene-0004.xhtml' in zip_obj.read('OEBPS/content.opf')
+    # The rebuilds are always incremental, so there is no --incremental.
+    from click.testing import CliRunner
+    result = CliRunner().invoke(_load_cli(), [
+        'watch', '--incremental', '--output', 'book.epub', 'book.json'])
+    assert result.exit_code == 2
+    assert "No such option" in result.output
+
+
+def test_splitting_oversized_chapters(tmp_path, monkeypatch):
+    import re
+    from lxml import etree
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=3)
+    sections = ''.join(
+        '<section class="scene" id="part-{0}">\n<header><h2 id="h-{0}">'
+        'Part {0}</h2></header>\n<p>{1}</p>\n<div><h3 id="s-{0}">Sub</h3>'
+        '<p>{1}</p></div>\n</section>\n'.format(idx, 'Lorem ipsum. ' * 40)
+        for idx in range(20))
+    with open('scene-0001.xhtml', 'rt') as fh:
+        text = fh.read()
+    with open('scene-0001.xhtml', 'wt') as fh:
+        fh.write(text.replace('</section>\n', '</section>\n' + sections))
+    json_data['toc']['max_chapter_bytes'] = 4000
+    rebookmaker.EbookMaker(validate=True).make_epub_from_data(
+        json_data, 'split.epub')
+    members = dict(_members('split.epub'))
+    names = [
+        name for name in members if name.startswith('OEBPS/scene-0001')]
+    assert len(names) > 3
+    assert 'OEBPS/scene-0001-part2.xhtml' in names
+    ids = {}
+    for name in names:
+        root = etree.fromstring(members[name])
+        assert root.find('{http://www.w3.org/1999/xhtml}head') is not None
+        for elem in root.iter():
+            if elem.get('id', '').startswith('h-'):
+                ids[elem.get('id')] = name[len('OEBPS/'):]
+        if len(members[name]) > 4000:
+            # Only a part with a single top level heading may be larger.
+            assert members[name].count(b'<h2') == 1
+    assert sorted(ids) == sorted('h-{}'.format(idx) for idx in range(20))
+    ncx = members['OEBPS/toc.ncx'].decode('utf-8')
+    for id_, part_name in ids.items():
+        assert '<content src="{}#{}"/>'.format(part_name, id_) in ncx
+    opf = members['OEBPS/content.opf'].decode('utf-8')
+    hrefs = re.findall('href="(scene-[^"]*)"', opf)
+    assert hrefs == ['scene-0000.xhtml'] + [
+        name[len('OEBPS/'):] for name in names] + ['scene-0002.xhtml']
+    # The sources which are not too large are not split.
+    del json_data['toc']['max_chapter_bytes']
+    rebookmaker.EbookMaker().make_epub_from_data(json_data, 'whole.epub')
+    assert 'OEBPS/scene-0001-part2.xhtml' not in dict(
+        _members('whole.epub'))
+
+
+def test_minification(tmp_path, monkeypatch):
+    from lxml import etree
+    import rebookmaker
+    from rebookmaker.minify import minify_css, minify_xhtml
+    assert minify_xhtml(
+        '<?xml version="1.0"?>\n<html>\n<!-- Generated file -->\n<body>\n'
+        '  <p>Some\n   text <!-- c --> with  <b>bold</b>  <i>it</i>.</p>\n'
+        '<pre>  keep\n   <!-- this -->  </pre>\n</body>\n</html>\n') == (
+        '<?xml version="1.0"?><html><body>'
+        '<p>Some\ntext with <b>bold</b> <i>it</i>.</p>'
+        '<pre>  keep\n   <!-- this -->  </pre></body></html>\n')
+    assert minify_css(
+        '/* Generated */\nbody\n{\n    font-family: "A  B", serif;\n}\n'
+        'a > b , p :hover { margin: 0; }\n') == \
+        'body{font-family: "A  B",serif}a>b,p :hover{margin: 0}\n'
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=3)
+    plain = rebookmaker.EbookMaker().make_epub_from_data(
+        json_data, 'plain.epub')
+    stats = rebookmaker.EbookMaker(minify=True).make_epub_from_data(
+        json_data, 'minified.epub')
+    assert plain.minified_before == 0
+    assert stats.minified_after < stats.minified_before
+    assert stats.headings == plain.headings
+    plain_members = dict(_members('plain.epub'))
+    members = dict(_members('minified.epub'))
+    assert sorted(members) == sorted(plain_members)
+    for name in members:
+        if name.endswith('.xhtml'):
+            assert len(members[name]) <= len(plain_members[name])
+            etree.fromstring(members[name])
+    assert b'<h2 id="scene-1-title">Scene 1 &amp; <b>more</b></h2>' in \
+        members['OEBPS/scene-0001.xhtml']
+    assert members['OEBPS/style.css'] == b'body{margin: 0}\n'
+    assert 'minified:' in stats.summary()
+
+
+def test_image_deduplication(tmp_path, monkeypatch):
+    import re
+    import rebookmaker
+    monkeypatch.chdir(tmp_path)
+    json_data = _write_book(str(tmp_path), num_scenes=4)
+    os.makedirs('graphics')
+    for fn in ['graphics/dice.png', 'graphics/cover-copy.png']:
+        with open(fn, 'wb') as fh:
+            fh.write(b'\x89PNG dice' if 'dice' in fn else b'\x89PNG cover')
+    for idx, image in [(2, 'graphics/dice.png'),
+                       (3, 'graphics/cover-copy.png')]:
+        fn = 'scene-{:04d}.xhtml'.format(idx)
+        with open(fn, 'rt') as fh:
+            text = fh.read()
+        with open(fn, 'wt') as fh:
+            fh.write(text.replace(
+                '<p>More text.</p>',
+                '<p><img alt="x" src=\'{}\' /></p>'.format(image)))
+    plain = rebookmaker.EbookMaker().make_epub_from_data(
+        json_data, 'plain.epub')
+    stats = rebookmaker.EbookMaker(
+        dedup_images=True, validate=True).make_epub_from_data(
+        json_data, 'dedup.epub')
+    assert plain.duplicate_images == 0
+    assert stats.duplicate_images == 2
+    assert stats.bytes_written < plain.bytes_written
+    members = dict(_members('dedup.epub'))
+    assert 'OEBPS/graphics/dice.png' in dict(_members('plain.epub'))
+    assert not [name for name in members if 'graphics/' in name]
+    assert b'src="images/dice.png"' in members['OEBPS/scene-0002.xhtml']
+    assert b'src="cover.png"' in members['OEBPS/scene-0003.xhtml']
+    assert b'graphics/' not in members['OEBPS/scene-0002.xhtml']
+    opf = members['OEBPS/content.opf'].decode('utf-8')
+    hrefs = re.findall('<item id="[a-z]*image[0-9]*" href="([^"]*)"', opf)
+    assert sorted(hrefs) == \
+        ['cover.png', 'images/dice.png', 'images/fish.jpg']